@@ -0,0 +1,5 @@
+"""Benchmarks for HippyBot's message handling path, these aren't installed
+with the package. Run them from a checkout, e.g.:
+
+    python -m benchmarks.dispatch --messages 1000000 --output report.json
+"""
@@ -0,0 +1,225 @@
+"""Message throughput benchmark.
+
+Builds a HippyBot against a fake connection and API, loads a mix of plugins
+and pushes synthetic groupchat and chat messages through callback_message()
+in batches. Reports messages per second, the cost of each command and
+handler (from hippybot.stats) and memory use, as JSON.
+"""
+import gc
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import logging
+import platform
+import resource
+import tempfile
+from optparse import OptionParser
+
+from jabberbot import xmpp
+
+from hippybot.stats import STATS
+from benchmarks.fakes import BenchBot, FakeApi, ORG_PREFIX, BOT_USER_ID
+
+PLUGINS = (
+    'hippybot.plugins.plusplusbot',
+    'hippybot.plugins.wave',
+    'hippybot.plugins.rot13',
+    'benchmarks.matchers',
+)
+
+# (weight, message type, body) of the synthetic traffic, %(user)s is
+# replaced with a random user's mention name
+MIX = (
+    (50, 'groupchat', u'just chatting about the weekend, nothing to see'),
+    (6, 'groupchat', u'%(user)s++'),
+    (4, 'groupchat', u'that build (flaky tests--) again'),
+    (8, 'groupchat', u'\\o/'),
+    (8, 'groupchat', u'@hippy rot13 the quick brown fox'),
+    (6, 'groupchat', u'can someone look at OPS-1234 please'),
+    (4, 'groupchat', u'https://github.com/example/hippybot/pull/42'),
+    (4, 'groupchat', u'deploying api to staging now'),
+    (2, 'groupchat', u'@hippy scores'),
+    (3, 'chat', u'rot13 private message'),
+    (5, 'chat', u'hello there'),
+)
+
+
+class Traffic(object):
+    """Generates synthetic message stanzas from MIX.
+    """
+    def __init__(self, api, seed=0):
+        self._random = random.Random(seed)
+        self._mix = []
+        for weight, type, body in MIX:
+            self._mix.extend([(type, body)] * weight)
+        self._users = api.user_items[1:]
+        self._rooms = [room['xmpp_jid'] for room in api.room_items]
+
+    def senders(self):
+        """Every JID messages can come from.
+        """
+        for room in self._rooms:
+            for user in self._users:
+                yield u'%s/%s' % (room, user['name'])
+        for user in self._users:
+            yield self._chat_jid(user)
+
+    def _chat_jid(self, user):
+        return u'%s_%d@chat.hipchat.com/desktop' % (ORG_PREFIX,
+                                                    user['user_id'])
+
+    def message(self):
+        type, body = self._random.choice(self._mix)
+        user = self._random.choice(self._users)
+        body = body % {'user': u'@' + user['mention_name']} \
+            if u'%(' in body else body
+        if type == 'groupchat':
+            frm = u'%s/%s' % (self._random.choice(self._rooms), user['name'])
+        else:
+            frm = self._chat_jid(user)
+        return xmpp.Message(to=u'%s_%d@chat.hipchat.com' % (ORG_PREFIX,
+                            BOT_USER_ID), body=body, typ=type, frm=frm)
+
+    def batch(self, size):
+        return [self.message() for _ in xrange(size)]
+
+
+def build_bot(options, workdir):
+    config = {
+        'connection': {
+            'username': '%s_%d' % (ORG_PREFIX, BOT_USER_ID),
+            'password': 'x',
+            'nickname': 'HippyBot',
+            'channels': 'room0',
+        },
+        'plugins': {'load': '\n'.join(options.plugins.split(','))},
+        'hipchat': {'lookup_snapshot': ''},
+        'flood': {'enabled': 'false'},
+        'performance': {'workers': str(options.workers)},
+        'storage': {'path': os.path.join(workdir, 'storage.sqlite')},
+    }
+    api = FakeApi(users=options.users, rooms=options.rooms)
+    bot = BenchBot(config, api)
+    bot.log.setLevel(logging.WARNING)
+    traffic = Traffic(api, seed=options.seed)
+    for jid in traffic.senders():
+        bot.mark_seen(xmpp.JID(jid))
+    return bot, traffic
+
+
+def run(bot, traffic, count, batch_size):
+    """Push count messages through the bot, returns the seconds spent
+    handling them (building the stanzas isn't counted).
+    """
+    elapsed = 0.0
+    done = 0
+    while done < count:
+        batch = traffic.batch(min(batch_size, count - done))
+        started = time.time()
+        for mess in batch:
+            bot.callback_message(bot.conn, mess)
+        if bot._pool is not None:
+            while bot._pool.pending():
+                time.sleep(0.001)
+        bot._outbound.drain(bot._send, force=True)
+        elapsed += time.time() - started
+        done += len(batch)
+    return elapsed
+
+
+def handler_costs():
+    costs = {}
+    for (name, labels), histogram in STATS.histograms():
+        if not histogram.count:
+            continue
+        key = ':'.join([name] + [str(value) for _, value in labels])
+        cost = {
+            'count': histogram.count,
+            'total_seconds': histogram.sum,
+            'mean_us': histogram.sum / histogram.count * 1e6,
+        }
+        for q, value in histogram.percentiles():
+            cost['p%d_us' % (q * 100)] = value * 1e6
+        costs[key] = cost
+    return costs
+
+
+def main(argv=None):
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("-n", "--messages", type="int", default=100000,
+                      help="Number of messages to send [%default]")
+    parser.add_option("-b", "--batch", type="int", default=10000,
+                      help="Messages built and sent per batch [%default]")
+    parser.add_option("-w", "--workers", type="int", default=0,
+                      help="Worker threads, 0 handles messages inline "
+                      "[%default]")
+    parser.add_option("--users", type="int", default=1000,
+                      help="Users in the synthetic org [%default]")
+    parser.add_option("--rooms", type="int", default=50,
+                      help="Rooms in the synthetic org [%default]")
+    parser.add_option("--plugins", default=','.join(PLUGINS),
+                      help="Comma separated plugin modules to load")
+    parser.add_option("--warmup", type="int", default=1000,
+                      help="Messages sent before measuring [%default]")
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("-o", "--output", dest="output",
+                      help="Write the JSON report to this file rather than "
+                      "stdout")
+    options, _ = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='hippybot-bench-')
+    try:
+        bot, traffic = build_bot(options, workdir)
+        run(bot, traffic, options.warmup, options.batch)
+        STATS.reset()
+
+        gc.collect()
+        objects = len(gc.get_objects())
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        sent = bot.conn.sent
+        elapsed = run(bot, traffic, options.messages, options.batch)
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        gc.collect()
+
+        report = {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'options': options.__dict__,
+            'messages': options.messages,
+            'seconds': elapsed,
+            'messages_per_second': options.messages / elapsed if elapsed
+                else None,
+            'stanzas_sent': bot.conn.sent - sent,
+            'handlers': handler_costs(),
+            'counters': dict((':'.join([name] + [str(v) for _, v in labels]),
+                              value) for (name, labels), value
+                             in STATS.counters()),
+            'memory': {
+                'objects_before': objects,
+                'objects_after': len(gc.get_objects()),
+                'max_rss_kb': after.ru_maxrss,
+                'user_seconds': after.ru_utime - usage.ru_utime,
+                'system_seconds': after.ru_stime - usage.ru_stime,
+            },
+        }
+        bot.shutdown()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(output + '\n')
+        print >> sys.stderr, '%d messages in %.2fs, %.0f messages/s' % (
+            options.messages, elapsed, report['messages_per_second'] or 0)
+    else:
+        print output
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""In-process stand-ins for the XMPP connection and HipChat API, so the bot
+can be driven without any network access.
+"""
+from hippybot.bot import HippyBot
+
+ORG_PREFIX = '1'
+BOT_USER_ID = 1
+
+
+class FakeConnection(object):
+    """Counts stanzas written by the bot instead of sending them.
+    """
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, stanza):
+        self.sent += 1
+
+    def Process(self, timeout=0):
+        return 0
+
+
+class _Section(object):
+    def __init__(self, name, items, key):
+        self._name = name
+        self._items = items
+        self._by_id = dict((item[key], item) for item in items)
+        self._key = key
+
+    def list(self, params=None):
+        return {self._name: [dict(item) for item in self._items]}
+
+    def show(self, params):
+        item = self._by_id.get(int(params[self._key]))
+        return {self._name[:-1]: dict(item)} if item else {}
+
+    def message(self, params):
+        return {'status': 'sent'}
+
+
+class FakeApi(object):
+    """Answers the HipChatApi calls made by Lookup and the Notifier from a
+    synthetic org of users and rooms, the first user is the bot.
+    """
+    def __init__(self, users=1000, rooms=50):
+        self.user_items = [{'user_id': i, 'name': u'User %d' % i,
+                            'mention_name': u'user%d' % i}
+                           for i in range(BOT_USER_ID, BOT_USER_ID + users)]
+        self.user_items[0].update(name=u'HippyBot', mention_name=u'hippy')
+        self.room_items = [{'room_id': i, 'name': u'room%d' % i,
+                            'xmpp_jid': u'%s_room%d@conf.hipchat.com' % (
+                                ORG_PREFIX, i)}
+                           for i in range(rooms)]
+        self.users = _Section('users', self.user_items, 'user_id')
+        self.rooms = _Section('rooms', self.room_items, 'room_id')
+
+
+class BenchBot(HippyBot):
+    """HippyBot wired to a FakeConnection and FakeApi. The real Lookup is
+    used, it just loads its users and rooms from the FakeApi.
+    """
+    def __init__(self, config, api):
+        self._fake_api = api
+        super(BenchBot, self).__init__(config)
+
+    @property
+    def api(self):
+        return self._fake_api
+
+    def connect(self):
+        if not isinstance(self.conn, FakeConnection):
+            self.conn = FakeConnection()
+        return self.conn
+
+    def mark_seen(self, jid):
+        """JabberBot ignores commands from JIDs it hasn't had presence
+        from.
+        """
+        self._JabberBot__seen[jid] = (self.AVAILABLE, None)
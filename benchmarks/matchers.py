@@ -0,0 +1,24 @@
+"""Plugin with a handful of typical @match handlers, loaded by the dispatch
+benchmark alongside the bundled plugins.
+"""
+from hippybot.decorators import match
+
+
+class Plugin(object):
+    @match(regex=r'\b([A-Z]{2,10}-\d+)\b')
+    def ticket(self, user, body, match=None):
+        return u'%s: https://issues.example.com/browse/%s' % (user,
+                                                              match.group(1))
+
+    @match(regex=r'https?://github\.com/([\w.-]+/[\w.-]+)/pull/(\d+)')
+    def pull_request(self, user, body, match=None):
+        return u'%s#%s' % match.groups()
+
+    @match(regex=r'\bdeploy(?:ed|ing)? (\w+) to (prod|staging)\b')
+    def deploy(self, user, body, match=None):
+        return u'%s is deploying %s to %s' % (user, match.group(1),
+                                              match.group(2))
+
+    @match(regex=r'\bcoffee\b')
+    def coffee(self, user, body, match=None):
+        return u'\u2615'
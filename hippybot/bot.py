@@ -1,18 +1,42 @@
 #!/usr/bin/env python
 import os
 import os.path
+import re
 import sys
+import errno
 import codecs
+import select
+import signal
 import time
 import traceback
 import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from jabberbot import botcmd, JabberBot, xmpp
 from ConfigParser import ConfigParser
 from optparse import OptionParser
 from inspect import ismethod
 from lazy_reload import lazy_reload
 
-from hippybot.hipchat import HipChatApi
+from hippybot.hipchat import api_from_config
+from hippybot.context import message_context
+from hippybot.decorators import cache_stats
+from hippybot.registry import PluginRegistration, Registry
+from hippybot.routing import Trigger, parse_rooms
+from hippybot.stats import STATS, serve as serve_stats
+from hippybot.watchdog import Watchdog, slow_log
+from hippybot.flood import FloodControl, \
+    DEFAULT_LIMITS as DEFAULT_FLOOD_LIMITS
+from hippybot.profiler import SamplingProfiler, DEFAULT_DURATION, \
+        DEFAULT_MAX_DURATION, DEFAULT_INTERVAL, DEFAULT_OUTPUT_DIR, \
+        DEFAULT_TOP
+from hippybot.workers import HandlerPool, Tier, DEFAULT_TIERS
+from hippybot.isolation import IsolatedPlugin, DEFAULT_PROCESSES, \
+    DEFAULT_TIMEOUT as DEFAULT_ISOLATION_TIMEOUT
+from hippybot.notify import Notifier
+from hippybot.outbound import OutboundQueue, DEFAULT_COALESCE_WINDOW
+from hippybot.storage import Storage, DEFAULT_PATH, DEFAULT_FLUSH_INTERVAL
 from hippybot.daemon.daemon import Daemon
 from hippybot.lookup import Lookup, USER_DOMAIN, ROOM_DOMAIN
 
@@ -20,8 +44,15 @@ from hippybot.lookup import Lookup, USER_DOMAIN, ROOM_DOMAIN
 # internal HippyBot methods
 RESERVED_COMMANDS = (
     'api',
+    'notifier',
+    'profile',
+    'stats',
+    'storage',
 )
 
+# Default maximum seconds the serve loop waits for incoming data
+POLL_INTERVAL = 0.1
+
 class Thing:
     pass
 
@@ -38,14 +69,14 @@ def do_import(name):
 class HippyBot(JabberBot):
 
     _timestamp = time.time()
-    _content_commands = {}
-    _global_commands = []
-    _command_aliases = {}
-    _all_msg_handlers = []
+    _registry = Registry()
     _last_message = ''
     _last_send_time = time.time()
     _restart = False
     _lookup = None
+    _pool = None
+    _watchdog = None
+    _flood = None
 
     def __init__(self, config):
         self._config = config
@@ -58,49 +89,99 @@ class HippyBot(JabberBot):
         username = u"%s@%s" % (config['connection']['username'], USER_DOMAIN)
         # Set this here as JabberBot sets username as private
         self._username = username
+        # Name the bot joins rooms with, the resource of its own messages
+        # echoed back by them
+        self._nickname = unicode(config['connection']['nickname'])
         super(HippyBot, self).__init__(username=username,
                                         password=config['connection']['password'])
         # Make sure we don't timeout after 150s
         self.PING_FREQUENCY = 50
+        # Commands provided by the bot itself, plugin commands are added to
+        # these each time the registry is rebuilt
+        self._base_commands = dict(self.commands)
+
+        # Plugin handlers can optionally be run by a pool of worker threads,
+        # rather than blocking the XMPP read loop
+        self._send_lock = threading.RLock()
+        performance = config.get('performance', {})
+        workers = int(performance.get('workers', 0))
+
+        # Outgoing messages are queued and sent from the serve loop, with
+        # per-room fairness, coalescing and an optional global rate
+        send_rate = float(performance.get('send_rate', 0)) or None
+        self._outbound = OutboundQueue(rate=send_rate,
+                burst=float(performance.get('send_burst', 0)) or None,
+                coalesce_window=float(performance.get('coalesce_window',
+                    DEFAULT_COALESCE_WINDOW)))
+        # Upper bound on how long the serve loop blocks waiting for data,
+        # this sets how often the outbound queue is drained
+        self._poll_interval = float(performance.get('poll_interval',
+                                                    POLL_INTERVAL))
+
+        if workers > 0:
+            self._pool = HandlerPool(workers, self._outbound.put,
+                    tiers=self._pool_tiers(performance),
+                    reserved=int(performance.get('reserved_workers', 1)))
+        self._watchdog = self._create_watchdog(config.get('watchdog', {}))
+        self._flood = self._create_flood_control(config.get('flood', {}))
+
+        # Startup is timed phase by phase, the user and room lists are
+        # fetched in the background meanwhile
+        self.startup_times = OrderedDict()
+        started = lap = time.time()
 
+        self._lookup = Lookup(self)
+        self._lookup.prefetch()
 
-        for channel in self._channels:
-            self.join_room(channel, config['connection']['nickname'])
+        self.connect()
+        self.startup_times['connect'] = time.time() - lap
+        lap = time.time()
 
-        self._lookup = Lookup(self)
+        self.join_rooms(self._channels, config['connection']['nickname'])
+        self.startup_times['join'] = time.time() - lap
+        lap = time.time()
 
         # To work in hipchat's actual chat rooms, the registered mention name
         # must be used in all cases. That requires fetching the hipchat user object.
         self._at_name = u"@%s " % self.bot_user().mention_name
         self._at_short_name = self._at_name
+        self.startup_times['bot_user'] = time.time() - lap
+        lap = time.time()
 
         plugins = config.get('plugins', {}).get('load', [])
         if plugins:
             plugins = plugins.strip().split('\n')
         self._plugin_modules = plugins
-        self._plugins = {}
 
         self.load_plugins()
+        self.startup_times['plugins'] = time.time() - lap
+        self.startup_times['total'] = time.time() - started
+
+        self._register_gauges()
+        port = int(config.get('stats', {}).get('http_port', 0))
+        if port:
+            serve_stats(port, config['stats'].get('http_host', '127.0.0.1'))
 
         self.log.setLevel(logging.INFO)
+        self.log.info('Started in %s' % ', '.join('%s %.2fs' % phase
+                      for phase in self.startup_times.iteritems()))
 
     def is_groupchat_message(self, mess):
         return mess.getType() == 'groupchat' 
 
     def get_sending_room(self, mess):
-        return self._lookup.get_sending_room(mess.getFrom())
+        return message_context(self, mess).room
 
     def get_sending_user(self, mess):
-        return self._lookup.get_sending_user(mess.getFrom())
+        return message_context(self, mess).user
 
     def bot_user(self):
-        return self._lookup.get_sending_user(self._username)
+        return self._lookup.resolve_user(self._username)
 
     def from_bot(self, mess):
         """Helper method to test if a message was sent from this bot.
         """
-        sender = self._lookup.get_sending_user(mess.getFrom())
-        return sender is not None and sender.xmpp_jid == self._username
+        return message_context(self, mess).from_bot
 
     def to_bot(self, mess):
         """Helper method to test if a message was directed at this bot.
@@ -133,63 +214,450 @@ class HippyBot(JabberBot):
 
     def send_message(self, mess):
         """Send an XMPP message
-        Overridden from jabberbot to update _last_send_time
+        Overridden from jabberbot to put messages on the outbound queue,
+        and to hold back replies from pooled handlers so they're sent in
+        arrival order.
+        """
+        job = self._pool.current() if self._pool else None
+        if job is not None:
+            if job.abandoned:
+                self.log.debug('Dropped reply from abandoned handler: %s' %
+                               mess)
+            else:
+                job.replies.append(mess)
+        else:
+            self._outbound.put(mess)
+
+    def _send(self, mess):
+        """Write a stanza to the connection, updating _last_send_time.
+        """
+        with self._send_lock:
+            self._last_send_time = time.time()
+            self.connect().send(mess)
+
+    def connect(self):
+        """Overridden from JabberBot to cap the time the serve loop spends
+        blocked in Process(), so the outbound queue is drained promptly.
         """
-        self._last_send_time = time.time()
-        self.connect().send(mess)
+        conn = super(HippyBot, self).connect()
+        if conn is not None and \
+                getattr(conn, '_hippybot_process', None) is None:
+            process = conn._hippybot_process = conn.Process
+            def capped_process(timeout=8):
+                try:
+                    return process(min(timeout, self._poll_interval))
+                except select.error, e:
+                    # Interrupted by a signal, e.g. SIGUSR1 to start the
+                    # profiler, which would otherwise end the serve loop
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    return '0'
+            conn.Process = capped_process
+        return conn
+
+    def idle_proc(self):
+        """Called by the JabberBot serve loop, sends queued messages.
+        """
+        try:
+            self._outbound.drain(self._send)
+        except IOError, e:
+            self.log.error('Error sending queued messages: %s' % e)
+        self._idle_ping()
 
     def callback_message(self, conn, mess):
         """Message handler, this is where we route messages and transform
         direct messages and message aliases into the command that will be
         matched by JabberBot.callback_message() to a registered command.
+
+        If a worker pool is configured in the [performance] section the
+        message is handed off to it, so slow plugins don't stall the read
+        loop, otherwise it's processed inline.
         """
-        self.log.debug("Message: %s" % mess)
-        message = unicode(mess.getBody()).strip()
-        if not message:
+        self.log.debug("Message: %s", mess)
+        STATS.incr('messages_total', type=mess.getType())
+        kind = self._classify(mess)
+        if kind is None:
+            return
+        if self._echoed(mess):
+            return
+        if self._flood is not None and not self._admit(mess, kind):
             return
+        if self._pool is None:
+            return self._process_message(conn, mess)
+        key = unicode(mess.getFrom().getStripped())
+        route = self._registry.routes.route(message_context(self, mess)
+                                            .room_name, mess.getType())
+        if route.all_msg_handlers:
+            listened = mess
+            if kind != 'content':
+                # Commands have the @mention stripped from their body while
+                # being routed, the all message handlers get their own copy
+                listened = xmpp.Message(node=mess)
+                listened.delChild('body')
+                listened.setBody(mess.getBody())
+            self._pool.submit_to('all_msg', key, self._process_message,
+                                 conn, listened, 'all_msg')
+        self._pool.submit_to(kind, key, self._process_message, conn, mess,
+                             kind)
+
+    def _echoed(self, mess):
+        """True if a message is the bot's own, echoed back by a room. Only
+        the sender's JID is compared, so the read loop never waits on a
+        user lookup for it.
+        """
+        jid = mess.getFrom()
+        if mess.getType() == 'groupchat':
+            return jid.getResource() == self._nickname
+        return jid.getStripped() == self._username
+
+    def _classify(self, mess):
+        """Returns the kind of a message: 'direct' for messages addressed
+        to the bot, 'global' for global commands and 'content' for the
+        rest. None if it's empty.
+        """
+        ctx = message_context(self, mess)
+        if not ctx.body.strip():
+            return None
+        if ctx.to_bot:
+            return 'direct'
+        registry = self._registry
+        cmd = registry.command_aliases.get(ctx.command, ctx.command)
+        if cmd in registry.global_commands:
+            return 'global'
+        return 'content'
+
+    def _admit(self, mess, kind):
+        """Checks a message against the flood control limits, returns
+        False if it should be dropped. The first time a sender or room goes
+        over a limit they're asked to slow down.
+        """
+        jid = mess.getFrom()
+        if message_context(self, mess).is_groupchat:
+            user, room = unicode(jid), unicode(jid.getStripped())
+        else:
+            user, room = unicode(jid.getStripped()), None
+        over = self._flood.check(kind, user, room)
+        if over is None:
+            return True
+        scope, first = over
+        if first:
+            if scope == 'user':
+                reply = u'Slow down! Ignoring your messages for a bit.'
+            else:
+                reply = u'Slow down! Ignoring messages in this room for a bit.'
+            self.send_simple_reply(mess, reply)
+        return False
 
-        at_msg, message = self.to_bot(mess)
+    def _pool_tiers(self, performance):
+        """Worker pool tiers, with the queue sizes and latency targets set
+        in the [performance] section.
+        """
+        queue_size = int(performance.get('queue_size', 0))
+        return [Tier(name, int(performance.get('%s_queue_size' % name,
+                                               queue_size)),
+                     float(performance.get('%s_target' % name, target)),
+                     sheddable)
+                for name, target, sheddable in DEFAULT_TIERS]
+
+    def _create_flood_control(self, config):
+        if config.get('enabled', 'true').lower() in ('false', 'no', 'off',
+                                                     '0'):
+            return None
+        limits = {}
+        for (kind, scope), (rate, burst) in DEFAULT_FLOOD_LIMITS.iteritems():
+            opt = '%s_%s_' % (kind, scope)
+            limits[(kind, scope)] = (float(config.get(opt + 'rate', rate)),
+                                     float(config.get(opt + 'burst', burst)))
+        return FloodControl(limits)
+
+    def _process_message(self, conn, mess, part=None):
+        """Routes a message to the plugins, either all of its handlers or,
+        when run by the worker pool, only the all message handlers
+        (part='all_msg') or only the others.
+        """
+        started = time.time()
+        try:
+            return self._route_message(conn, mess,
+                                       listeners=part in (None, 'all_msg'),
+                                       handlers=part != 'all_msg')
+        finally:
+            STATS.observe('message_seconds', time.time() - started,
+                          type=mess.getType())
+
+    def _route_message(self, conn, mess, listeners=True, handlers=True):
+        ctx = message_context(self, mess)
+        if not ctx.body.strip():
+            return
+
+        # Hold on to the registry for the whole message, so a concurrent
+        # plugin reload can't change the handlers half way through
+        registry = self._registry
+
+        route = registry.routes.route(ctx.room_name, mess.getType())
+
+        at_msg, message = ctx.to_bot, ctx.message
         mess.to_bot = at_msg
 
-        if len(self._all_msg_handlers) > 0:
-            for handler in self._all_msg_handlers:
-                try:
-                    handler(mess)
-                except Exception, e:
-                    self.log.exception(
-                            'An error happened while processing '
-                            'a message ("%s") from %s: %s"' %
-                            (mess.getType(), mess.getFrom(),
-                                traceback.format_exc(e)))
-
-        if u' ' in message:
-            cmd = message.split(u' ')[0]
-        else:
-            cmd = message
+        if listeners:
+            for name, handler, trigger in route.all_msg_handlers:
+                if trigger is not None and not trigger.matches(ctx.body):
+                    continue
+                if self._cooling(name):
+                    continue
+                with self._watch(name, mess):
+                    try:
+                        handler(mess)
+                    except Exception, e:
+                        STATS.incr('handler_errors_total', handler=name)
+                        self.log.exception(
+                                'An error happened while processing '
+                                'a message ("%s") from %s: %s"' %
+                                (mess.getType(), mess.getFrom(),
+                                    traceback.format_exc(e)))
+
+        if not handlers:
+            return
+
+        cmd = ctx.command
 
-        if cmd in self._command_aliases:
-            message = u"%s%s" % (self._command_aliases[cmd],
+        if cmd in registry.command_aliases:
+            message = u"%s%s" % (registry.command_aliases[cmd],
                                 message[len(cmd):])
-            cmd = self._command_aliases[cmd]
+            cmd = registry.command_aliases[cmd]
+        # Command names are matched case insensitively, as jabberbot does
+        name = cmd.lower()
 
         ret = None
-        if at_msg or cmd in self._global_commands:
-            mess.setBody(message)
-            ret = super(HippyBot, self).callback_message(conn, mess)
+        if name in route.blocked_commands:
+            # Not enabled for this room or type of message, so it's left to
+            # the content handlers like any other message
+            pass
+        elif at_msg or cmd in registry.global_commands:
+            ctx.set_body(message)
+            if name not in registry.commands:
+                ret = super(HippyBot, self).callback_message(conn, mess)
+            elif self._cooling(name):
+                self.send_simple_reply(mess, u'"%s" is disabled for %ds, '
+                    'it has been taking too long' % (name,
+                                                     self._cooling(name)))
+            else:
+                with self._watch(name, mess, 'command_seconds', 'command'):
+                    ret = super(HippyBot, self).callback_message(conn, mess)
         self._last_message = message
         if ret:
             return ret
-        for name in self._content_commands:
-            try:
-                cmd = self._content_commands[name]
-                ret = cmd(mess)
-                if ret:
-                    self.send_simple_reply(mess, ret)
-                    return ret
-            except Exception as e:
-                self.log.exception(e)
-                logging.exception(e)
-                return 'Error processing cmd'
+        for name, cmd in route.content_dispatcher.handlers(mess,
+                                                           self.from_bot):
+            if self._cooling(name):
+                continue
+            with self._watch(name, mess):
+                try:
+                    ret = cmd(mess)
+                    if ret:
+                        self.send_simple_reply(mess, ret)
+                        return ret
+                except Exception as e:
+                    STATS.incr('handler_errors_total', handler=name)
+                    self.log.exception(e)
+                    logging.exception(e)
+                    return 'Error processing cmd'
+
+    @contextmanager
+    def _watch(self, name, mess, metric='handler_seconds', label='handler'):
+        """Times a plugin handler for the stats, and has the watchdog keep
+        an eye on it.
+        """
+        run = None
+        if self._watchdog is not None:
+            run = self._watchdog.start(name, mess,
+                                       self._pool and self._pool.current())
+        started = time.time()
+        try:
+            yield
+        finally:
+            STATS.observe(metric, time.time() - started, **{label: name})
+            if run is not None:
+                self._watchdog.finish(run)
+
+    def _cooling(self, name):
+        """Seconds left of the handler's watchdog cooldown, 0 if it can
+        run.
+        """
+        if self._watchdog is None:
+            return 0
+        return self._watchdog.cooling(name)
+
+    def _create_watchdog(self, config):
+        if config.get('enabled', 'true').lower() in ('false', 'no', 'off',
+                                                     '0'):
+            return None
+        slow_log_path = config.get('slow_log')
+        if slow_log_path:
+            slow_log_path = os.path.abspath(os.path.expanduser(slow_log_path))
+            if not any(getattr(h, 'baseFilename', None) == slow_log_path
+                       for h in slow_log.handlers):
+                try:
+                    directory = os.path.dirname(slow_log_path)
+                    if not os.path.exists(directory):
+                        os.makedirs(directory)
+                    handler = logging.FileHandler(slow_log_path)
+                except (IOError, OSError), e:
+                    # Slow handlers still reach the bot's own log
+                    self.log.error('Unable to open slow log %s: %s' % (
+                        slow_log_path, e))
+                else:
+                    handler.setFormatter(logging.Formatter(
+                        '%(asctime)s %(message)s'))
+                    slow_log.addHandler(handler)
+        budgets = dict((key[len('budget.'):], float(value))
+                       for key, value in config.items()
+                       if key.startswith('budget.'))
+        kwargs = {}
+        for opt in ('budget', 'slow_threshold', 'strike_window', 'cooldown'):
+            if opt in config:
+                kwargs[opt] = float(config[opt])
+        if 'strikes' in config:
+            kwargs['strikes'] = int(config['strikes'])
+        return Watchdog(budgets=budgets, on_overrun=self._abandon, **kwargs)
+
+    def _abandon(self, run):
+        """Called by the watchdog for handlers over budget, gives up on
+        the worker pool job running it. Handlers run inline in the serve
+        loop can't be abandoned.
+        """
+        if run.job is not None and self._pool.abandon(run.job):
+            self.log.error('Abandoned handler %s, a new worker has been '
+                           'started' % run.name)
+
+    def shutdown(self):
+        """Overridden from JabberBot to stop the worker pool, send any
+        queued messages and notifications and flush plugin storage.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+        if self._watchdog is not None:
+            self._watchdog.close()
+        try:
+            self._outbound.drain(self._send, force=True)
+        except IOError, e:
+            self.log.error('Unable to send queued messages: %s' % e)
+        if self._notifier is not None:
+            self._notifier.close()
+        if self._storage is not None:
+            self._storage.close()
+        for registration in self._registry.registrations.itervalues():
+            registration.close()
+
+    def _register_gauges(self):
+        """Exposes the queue depths and counters of the bot's services as
+        stats gauges.
+        """
+        outbound = self._outbound
+        STATS.gauge('outbound_queued', outbound.__len__)
+        STATS.gauge('outbound_sent', lambda: outbound.sent)
+        STATS.gauge('outbound_merged', lambda: outbound.merged)
+        if self._pool is not None:
+            for tier in self._pool.tiers:
+                STATS.gauge('pool_queued', lambda tier=tier.name:
+                            self._pool.depth(tier), tier=tier.name)
+        STATS.gauge('notifier_queued',
+                    lambda: self._notifier and self._notifier.depth())
+        for attr in ('sent', 'dropped', 'failed'):
+            STATS.gauge('notifier_%s' % attr,
+                        lambda attr=attr: getattr(self._notifier, attr, None))
+        STATS.gauge('storage_pending',
+                    lambda: self._storage and self._storage.pending())
+        STATS.collector('cache', self._cache_gauges)
+        if self._flood is not None:
+            STATS.gauge('flood_buckets', self._flood.__len__)
+
+    def _cache_gauges(self):
+        for name, stats in cache_stats().iteritems():
+            for attr in ('hits', 'misses', 'size'):
+                yield 'cache_%s' % attr, {'cache': name}, stats[attr]
+
+    @botcmd(hidden=True)
+    def stats(self, mess, args):
+        """Shows message, command and API counters and timings
+        """
+        lines = STATS.summary()
+        if args:
+            lines = [line for line in lines if args.strip() in line]
+        return u'\n'.join(lines) or u'No stats recorded'
+
+    _profiler = None
+    def start_profiler(self, duration=None, callback=None):
+        """Starts sampling the process for duration seconds, see the
+        [profiler] section of the config for the defaults and the longest
+        allowed. Returns the SamplingProfiler, or None if one is already
+        running.
+        """
+        if self._profiler is not None and self._profiler.running:
+            return None
+        config = self._config.get('profiler', {})
+        duration = min(duration or float(config.get('duration',
+                                                    DEFAULT_DURATION)),
+                       float(config.get('max_duration', DEFAULT_MAX_DURATION)))
+        self._profiler = SamplingProfiler(
+            duration=duration,
+            interval=float(config.get('interval', DEFAULT_INTERVAL)),
+            output_dir=os.path.expanduser(config.get('output_dir',
+                                                     DEFAULT_OUTPUT_DIR)),
+            top=int(config.get('top', DEFAULT_TOP)),
+            callback=callback)
+        self._profiler.start()
+        self.log.info('Profiling for %gs' % self._profiler.duration)
+        return self._profiler
+
+    @botcmd(hidden=True)
+    def profile(self, mess, args):
+        """Profiles the bot for a number of seconds and replies with the
+        hottest functions, "profile stop" ends it early
+        """
+        if not self._may_profile(mess):
+            return u'Sorry, only admins can use profile'
+        args = args.strip()
+        if args == 'stop':
+            if self._profiler is None or not self._profiler.running:
+                return u'The profiler is not running'
+            self._profiler.stop()
+            return u'Stopping the profiler..'
+        try:
+            duration = float(args) if args else None
+        except ValueError:
+            return u'Usage: profile [seconds|stop]'
+        if duration is not None and not duration > 0:
+            return u'Usage: profile [seconds|stop]'
+
+        def done(profiler):
+            lines = profiler.summary()[:8]
+            if profiler.paths:
+                lines.append(u'Written to %s' % u', '.join(profiler.paths))
+            self.send_simple_reply(mess, u'\n'.join(lines))
+
+        profiler = self.start_profiler(duration, done)
+        if profiler is None:
+            return u'The profiler is already running'
+        return u'Profiling for %gs..' % profiler.duration
+
+    def _may_profile(self, mess):
+        """Profiling is limited to the users listed by mention name in the
+        admins option of the [profiler] section, nobody may profile if
+        there are none.
+        """
+        admins = set(name.lstrip('@').lower() for name in re.split(
+            r'[,\s]+', self._config.get('profiler', {}).get('admins', ''))
+            if name)
+        if not admins:
+            return False
+        ctx = message_context(self, mess)
+        return ctx.user is not None and \
+            ctx.user.mention_name.lower() in admins
+
+    def cache_stats(self):
+        """Hit and miss counters of commands memoized with @cached.
+        """
+        return cache_stats()
 
     def up_time(self):
         return time.time() - self._timestamp
@@ -197,6 +665,18 @@ class HippyBot(JabberBot):
     def join_room(self, room, username=None, password=None):
         """Overridden from JabberBot to provide history limiting.
         """
+        self.connect().send(self._join_presence(room, username, password))
+
+    def join_rooms(self, rooms, username=None, password=None):
+        """Joins several rooms at once, the presence stanzas are written to
+        the connection together rather than one by one.
+        """
+        presences = [unicode(self._join_presence(room, username, password))
+                     for room in rooms]
+        if presences:
+            self.connect().send(u''.join(presences).encode('utf-8'))
+
+    def _join_presence(self, room, username=None, password=None):
         NS_MUC = 'http://jabber.org/protocol/muc'
         if username is None:
             username = self._username.split('@')[0]
@@ -210,7 +690,7 @@ class HippyBot(JabberBot):
         # Don't pull the history back from the server on joining channel
         pres.getTag('x').addChild('history', {'maxchars': '0',
                                                 'maxstanzas': '0'})
-        self.connect().send(pres)
+        return pres
 
     def _idle_ping(self):
         """Pings the server, calls on_ping_timeout() on no response.
@@ -218,98 +698,175 @@ class HippyBot(JabberBot):
         To enable set self.PING_FREQUENCY to a value higher than zero.
 
         Overridden from jabberbot in order to send a single space message
-        to HipChat, as XMPP ping doesn't seem to cut it.
+        to HipChat, as XMPP ping doesn't seem to cut it. No ping is needed
+        while the outbound queue still has messages to send.
         """
-        if self.PING_FREQUENCY \
+        if self.PING_FREQUENCY and not len(self._outbound) \
             and time.time() - self._last_send_time > self.PING_FREQUENCY:
-            self._last_send_time = time.time()
-            self.send_message(' ')
+            self._send(' ')
 
     def rewrite_docstring(self, m):
         if m.__doc__ and m.__doc__.find("@NickName") > -1:
-            m.__func__.__doc__ = m.__doc__.replace("@NickName", self._at_name)
+            getattr(m, '__func__', m).__doc__ = m.__doc__.replace(
+                "@NickName", self._at_name)
 
     @botcmd(hidden=True)
     def load_plugins(self, mess=None, args=None):
         """Internal handler and bot command to dynamically load and reload
         plugin classes based on the [plugins][load] section of the config.
+
+        Only modules whose source has changed since they were loaded are
+        reloaded, "load_plugins all" reloads every module.
         """
+        force = (args or '').strip() == 'all'
+        current = self._registry.registrations
+        registrations = []
+        reloaded = 0
         for path in self._plugin_modules:
             name = path.split('.')[-1]
+            registration = current.get(name)
+            if registration is not None and not force and \
+                    not registration.changed():
+                registrations.append(registration)
+                continue
             try:
-                if name in self._plugins:
-                    lazy_reload(self._plugins[name])
+                if registration is not None:
+                    lazy_reload(registration.module)
                 module = do_import(path)
-                self._plugins[name] = module
+                registration = self._register_plugin(name, module)
             except Exception as e:
                 self.log.warn('Unable to load plugin: %s', name)
                 logging.warn('Unable to load plugin: %s', name)
                 logging.exception(e)
+                # Keep the previously loaded version, if any
+                if registration is not None:
+                    registrations.append(registration)
                 continue
+            registrations.append(registration)
+            reloaded += 1
 
-            # If the module has a function matching the module/command name,
-            # then just use that
-            command = getattr(module, name, None)
-
-            content_funcs = []
-            if not command:
-                # Otherwise we're looking for a class called Plugin which
-                # provides methods decorated with the @botcmd decorator.
-                plugin = getattr(module, 'Plugin')()
-                plugin.bot = self
-                commands = [c for c in dir(plugin)]
-                funcs = []
-
-                for command in commands:
-                    m = getattr(plugin, command)
-                    if ismethod(m) and getattr(m, '_jabberbot_command', False):
-                        if command in RESERVED_COMMANDS:
-                            self.log.error('Plugin "%s" attempted to register '
-                                        'reserved command "%s", skipping..' % (
-                                            plugin, command
-                                        ))
-                            continue
-                        self.rewrite_docstring(m)
-                        name = getattr(m, '_jabberbot_command_name', False)
-                        self.log.info("command loaded: %s" % name)
-                        funcs.append((name, m))
-
-                    if ismethod(m) and getattr(m, '_jabberbot_content_command', False):
-                        if command in RESERVED_COMMANDS:
-                            self.log.error('Plugin "%s" attempted to register '
-                                        'reserved command "%s", skipping..' % (
-                                            plugin, command
-                                        ))
-                            continue
-                        self.rewrite_docstring(m)
-                        name = getattr(m, '_jabberbot_command_name', False)
-                        self.log.info("command loaded: %s" % name)
-                        content_funcs.append((name, m))
-
-                # Check for commands that don't need to be directed at
-                # hippybot, e.g. they can just be said in the channel
-                self._global_commands.extend(getattr(plugin,
-                                                'global_commands', []))
-                # Check for "special commands", e.g. those that can't be
-                # represented in a python method name
-                self._command_aliases.update(getattr(plugin,
-                                                'command_aliases', {}))
-
-                # Check for handlers for all XMPP message types,
-                # this can be used for low-level checking of XMPP messages
-                self._all_msg_handlers.extend(getattr(plugin,
-                                                'all_msg_handlers', []))
+        self._swap_registry(Registry(self._base_commands, registrations,
+                                     self._plugin_triggers()))
+        if mess:
+            return 'Reloaded %d of %d plugin modules' % (
+                reloaded, len(self._plugin_modules))
+
+    def _plugin_triggers(self):
+        """Returns the Triggers for plugins enabled in or excluded from
+        some rooms by the [plugins] section, by plugin name. Options are
+        named after the plugin module, e.g. wave.rooms or
+        hippybot.plugins.wave.exclude_rooms.
+        """
+        triggers = {}
+        for path in self._plugin_modules:
+            rooms, exclude_rooms = [parse_rooms(self._plugin_option(path,
+                                                                    option))
+                                    for option in ('rooms', 'exclude_rooms')]
+            if rooms or exclude_rooms:
+                triggers[path.split('.')[-1]] = Trigger(rooms, exclude_rooms)
+        return triggers
+
+    def _plugin_option(self, path, option, default=None):
+        """Returns a per plugin option of the [plugins] section, named
+        after either the plugin's module name or its full path.
+        """
+        config = self._config.get('plugins', {})
+        value = config.get('%s.%s' % (path.split('.')[-1], option))
+        if value is None:
+            value = config.get('%s.%s' % (path, option), default)
+        return value
+
+    def _register_plugin(self, name, module):
+        """Collects the commands and handlers provided by a plugin module,
+        returns a PluginRegistration.
+        """
+        # If the module has a function matching the module/command name,
+        # then just use that
+        command = getattr(module, name, None)
+        if command:
+            registration = PluginRegistration(name, module)
+            registration.commands.append((name, command))
+            return registration
+
+        # Otherwise we're looking for a class called Plugin which
+        # provides methods decorated with the @botcmd decorator.
+        isolated = None
+        if self._plugin_option(module.__name__, 'isolation') == 'process':
+            # The plugin only runs in worker processes, its class is just
+            # inspected for the handlers to register proxies for
+            isolated = IsolatedPlugin(self, module.__name__,
+                processes=int(self._plugin_option(module.__name__,
+                    'processes', DEFAULT_PROCESSES)),
+                timeout=float(self._plugin_option(module.__name__,
+                    'timeout', DEFAULT_ISOLATION_TIMEOUT)))
+            plugin = getattr(module, 'Plugin')
+            registration = PluginRegistration(name, module)
+            registration.isolated = isolated
+        else:
+            plugin = getattr(module, 'Plugin')()
+            plugin.bot = self
+            registration = PluginRegistration(name, module, plugin)
+
+        for attr in dir(plugin):
+            m = getattr(plugin, attr)
+            if not ismethod(m):
+                continue
+            if getattr(m, '_jabberbot_command', False):
+                funcs = registration.commands
+            elif getattr(m, '_jabberbot_content_command', False):
+                funcs = registration.content_commands
             else:
-                funcs = [(name, command)]
+                continue
+            if attr in RESERVED_COMMANDS:
+                self.log.error('Plugin "%s" attempted to register '
+                            'reserved command "%s", skipping..' % (
+                                plugin, attr
+                            ))
+                continue
+            if isolated is not None:
+                m = isolated.proxy(attr, m)
+            self.rewrite_docstring(m)
+            command = getattr(m, '_jabberbot_command_name', False)
+            self.log.info("command loaded: %s" % command)
+            funcs.append((command, m))
+
+        # Check for commands that don't need to be directed at
+        # hippybot, e.g. they can just be said in the channel
+        registration.global_commands = tuple(getattr(plugin,
+                                            'global_commands', ()))
+        # Check for "special commands", e.g. those that can't be
+        # represented in a python method name
+        registration.command_aliases = dict(getattr(plugin,
+                                            'command_aliases', {}))
+
+        # Check for handlers for all XMPP message types,
+        # this can be used for low-level checking of XMPP messages
+        if isolated is not None:
+            registration.all_msg_handlers = tuple(
+                isolated.all_msg_proxies())
+        else:
+            registration.all_msg_handlers = tuple(getattr(plugin,
+                                                'all_msg_handlers', ()))
+        return registration
 
-            for command, func in funcs:
-                setattr(self, command, func)
-                self.commands[command] = func
-            for command, func in content_funcs:
+    def _swap_registry(self, registry):
+        """Makes a newly built registry the live one.
+        """
+        stale = self._registry.plugin_commands()
+        for registration in self._registry.registrations.itervalues():
+            if registration is not registry.registrations.get(
+                    registration.name):
+                registration.close()
+        self._registry = registry
+        self.commands = registry.commands
+        # Plugin commands are also exposed as attributes of the bot
+        for registration in registry.registrations.itervalues():
+            for command, func in registration.commands + \
+                    registration.content_commands:
                 setattr(self, command, func)
-                self._content_commands[command] = func
-        if mess:
-            return 'Reloading plugin modules and classes..'
+                stale.discard(command)
+        for command in stale:
+            self.__dict__.pop(command, None)
 
     _api = None
     @property
@@ -317,19 +874,53 @@ class HippyBot(JabberBot):
         """Accessor for lazy-loaded HipChatApi instance
         """
         if self._api is None:
-            auth_token = self._config.get('hipchat', {}).get(
-                'api_auth_token', None)
-            if auth_token is None:
-                self._api = False
-            else:
-                self._api = HipChatApi(auth_token=auth_token)
+            self._api = api_from_config(self._config.get('hipchat', {}))
         return self._api
 
+    _notifier = None
+    @property
+    def notifier(self):
+        """Accessor for the lazy-loaded Notifier used to send room
+        notifications in the background, None if there's no API token.
+        """
+        if self._notifier is None and self.api:
+            with self._send_lock:
+                if self._notifier is None:
+                    hipchat = self._config.get('hipchat', {})
+                    kwargs = {}
+                    if 'notify_backoff' in hipchat:
+                        kwargs['backoff'] = float(hipchat['notify_backoff'])
+                    for opt in ('retries', 'queue_size'):
+                        if 'notify_%s' % opt in hipchat:
+                            kwargs[opt] = int(hipchat['notify_%s' % opt])
+                    self._notifier = Notifier(self.api, **kwargs)
+        return self._notifier
+
+    _storage = None
+    @property
+    def storage(self):
+        """Accessor for the lazy-loaded Storage service shared by plugins
+        """
+        if self._storage is None:
+            with self._send_lock:
+                if self._storage is None:
+                    config = self._config.get('storage', {})
+                    self._storage = Storage(
+                        path=os.path.expanduser(config.get('path',
+                                                           DEFAULT_PATH)),
+                        flush_interval=float(config.get('flush_interval',
+                                                    DEFAULT_FLUSH_INTERVAL)))
+        return self._storage
+
 class HippyDaemon(Daemon):
     config = None
     def run(self):
         try:
             bot = HippyBot(self.config._sections)
+            if hasattr(signal, 'SIGUSR1'):
+                # kill -USR1 <pid> profiles the running bot
+                signal.signal(signal.SIGUSR1,
+                              lambda signum, frame: bot.start_profiler())
             bot.serve_forever()
         except Exception, e:
             print >> sys.stderr, "ERROR: %s" % (e,)
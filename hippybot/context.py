@@ -0,0 +1,111 @@
+from hippybot.routing import room_name
+
+
+class lazy(object):
+    """Non-data descriptor that computes an attribute on first access and
+    stores it on the instance, so later reads are plain attribute lookups.
+    """
+    def __init__(self, func):
+        self.func = func
+        self.__name__ = func.__name__
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        value = obj.__dict__[self.__name__] = self.func(obj)
+        return value
+
+
+class MessageContext(object):
+    """Per-stanza cache of everything handlers commonly need to know about
+    an inbound message. Each value is resolved at most once, however many
+    plugins ask for it.
+    """
+    def __init__(self, bot, mess):
+        self.bot = bot
+        self.mess = mess
+
+    @lazy
+    def body(self):
+        """The message body as unicode, this tracks rewrites made by the bot
+        while routing (e.g. stripping the @mention).
+        """
+        return unicode(self.mess.getBody() or u'')
+
+    @lazy
+    def jid(self):
+        return self.mess.getFrom()
+
+    @lazy
+    def is_groupchat(self):
+        return self.mess.getType() == 'groupchat'
+
+    @lazy
+    def room_name(self):
+        """Channel name of the room the message was sent to, None for one
+        to one chats.
+        """
+        if not self.is_groupchat:
+            return None
+        return room_name(self.jid)
+
+    @lazy
+    def user(self):
+        return self.bot._lookup.get_sending_user(self.jid)
+
+    @lazy
+    def room(self):
+        return self.bot._lookup.get_sending_room(self.jid)
+
+    @lazy
+    def mention(self):
+        """@mention for the sender, or None if they're unknown.
+        """
+        if self.user is None:
+            return None
+        return u'@%s' % self.user.mention_name
+
+    @lazy
+    def from_bot(self):
+        user = self.user
+        return user is not None and user.xmpp_jid == self.bot._username
+
+    def _resolve_to_bot(self):
+        self.to_bot, self.message = self.bot.to_bot(self.mess)
+
+    @lazy
+    def to_bot(self):
+        """True if the message was addressed to the bot.
+        """
+        self._resolve_to_bot()
+        return self.to_bot
+
+    @lazy
+    def message(self):
+        """The message text with any leading @mention of the bot stripped.
+        """
+        self._resolve_to_bot()
+        return self.message
+
+    @lazy
+    def command(self):
+        """First word of the message, i.e. the command name if any.
+        """
+        return self.message.split(u' ', 1)[0]
+
+    def set_body(self, body):
+        """Rewrite the body of the underlying stanza.
+        """
+        self.mess.setBody(body)
+        self.body = unicode(body)
+
+
+def message_context(bot, mess):
+    """Returns the MessageContext attached to an inbound stanza, creating
+    it if needed.
+    """
+    ctx = getattr(mess, 'context', None)
+    if ctx is None:
+        ctx = mess.context = MessageContext(bot, mess)
+    return ctx
@@ -2,14 +2,23 @@ from functools import wraps, update_wrapper
 from jabberbot import botcmd
 import re
 import logging
+from hippybot.cache import LRUCache
+from hippybot.context import message_context
+from hippybot.routing import Trigger
+
+# Caches created by @cached, keyed by "module.function", so the bot can
+# report their hit and miss counters
+CACHES = {}
+
+_MISSING = object()
 
 def directcmd(func):
     @wraps(func)
     def wrapper(self, origin, args):
         message = func(self, origin, args)
-        if origin.getType() == 'groupchat':
-            user = self.bot.get_sending_user(origin)
-            return u'@%s %s' % (user.mention_name, message)
+        mention = message_context(self.bot, origin).mention
+        if origin.getType() == 'groupchat' and mention:
+            return u'%s %s' % (mention, message)
         else:
             return message
     return botcmd(wrapper)
@@ -24,6 +33,54 @@ def direct(fn):
     return update_wrapper(_direct, fn)
 
 
+def cached(ttl=None, maxsize=128, key=None, room=False):
+    """Decorator to memoize the result of a bot command.
+
+    By default results are keyed by command name and arguments, and also
+    by room if room is True. A custom key function can be given instead,
+    it's called with the same arguments as the command. Entries expire
+    after ttl seconds (never if None) and the least recently used are
+    evicted beyond maxsize. Stacks with @botcmd in either order, but should
+    go below @directcmd so the cached reply doesn't include an @mention:
+
+        @directcmd
+        @cached(ttl=60)
+        def lookup(self, mess, args):
+            ...
+
+    The wrapped function exposes the cache as .cache, and .invalidate() to
+    clear it.
+    """
+    def decorate(func):
+        cache = LRUCache(maxsize=maxsize, ttl=ttl)
+        name = getattr(func, '_jabberbot_command_name', func.__name__)
+
+        @wraps(func)
+        def wrapper(self, mess, args, *a, **kw):
+            if key is not None:
+                k = key(self, mess, args, *a, **kw)
+            elif room:
+                k = (name, args, unicode(mess.getFrom()).split('/')[0])
+            else:
+                k = (name, args)
+            value = cache.get(k, _MISSING)
+            if value is _MISSING:
+                value = func(self, mess, args, *a, **kw)
+                cache.set(k, value)
+            return value
+        wrapper.cache = cache
+        wrapper.invalidate = cache.invalidate
+        CACHES['%s.%s' % (func.__module__, func.__name__)] = cache
+        return wrapper
+    return decorate
+
+
+def cache_stats():
+    """Returns hit/miss counters and sizes of all @cached commands.
+    """
+    return dict((name, cache.stats()) for name, cache in CACHES.items())
+
+
 def contentcmd(*args, **kwargs):
     """Decorator for bot commentary"""
 
@@ -39,74 +96,102 @@ def contentcmd(*args, **kwargs):
 
 
 
+def trigger(rooms=None, exclude_rooms=None, types=None, contains=None):
+    """Decorator declaring which messages a command or handler wants to
+    see, e.g. @trigger(types=['groupchat'], contains=['++', '--']). Messages
+    that don't qualify never reach it, see hippybot.routing.Trigger."""
+
+    def decorate(func):
+        func._hippybot_trigger = Trigger(rooms, exclude_rooms, types,
+                                         contains)
+        return func
+    return decorate
+
+
 def listen(fn):
     """Decorator for bot commentary that listens to all chatter"""
     setattr(fn, '_jabberbot_content_command', True)
     setattr(fn, '_jabberbot_command_name', fn.__name__)
     @wraps(fn)
     def _listen(ctx, msg, *args, **kwargs):
-        if not msg or not msg.getBody() or ctx.bot.from_bot(msg):
+        if not msg or not msg.getBody():
+            return
+        context = message_context(ctx.bot, msg)
+        if context.from_bot:
             return
         else:
-            user = '@%s' % ctx.bot.get_sending_user(msg).mention_name
-            room_id = sending_room = ctx.bot.get_sending_room(msg).room_id
-            return fn(ctx, user, msg.getBody(), room_id=room_id, **kwargs)
+            return fn(ctx, context.mention, msg.getBody(),
+                      room_id=context.room.room_id, **kwargs)
     return update_wrapper(_listen, fn)
 
 
 
 def match(regex=None):
     """Decorator for bot commentary that matches a regular expression"""
+    pattern = re.compile(regex, re.IGNORECASE) if regex else None
+
     def _match(fn):
         setattr(fn, '_jabberbot_content_command', True)
         setattr(fn, '_jabberbot_command_name', fn.__name__)
 
+        def _on_match(ctx, msg, m):
+            user = message_context(ctx.bot, msg).mention
+            return fn(ctx, user, msg.getBody(), match=m)
+
         @wraps(fn)
         def __match(ctx, msg, *args, **kwargs):
-            if not regex or not msg or not msg.getBody() or ctx.bot.from_bot(msg):
+            if not pattern or not msg or not msg.getBody() or ctx.bot.from_bot(msg):
                 return
             else:
-                m = re.search(regex, msg.getBody(), re.IGNORECASE)
+                m = pattern.search(msg.getBody())
                 if m:
-                    user = '@%s' % ctx.bot.get_sending_user(msg).mention_name
+                    user = message_context(ctx.bot, msg).mention
                     return fn(ctx, user, msg.getBody(), match=m, **kwargs)
                 return
-        return update_wrapper(__match, fn)
+        __match = update_wrapper(__match, fn)
+        __match._hippybot_regex = pattern
+        __match._hippybot_on_match = _on_match
+        return __match
 
     return _match
 
 
 def status(color='purple', regex=None):
     """Decorator for bot commentary that submits a status message of html with color"""
+    pattern = re.compile(regex, re.IGNORECASE) if regex else None
+
     def _status(fn):
         setattr(fn, '_jabberbot_content_command', True)
         setattr(fn, '_jabberbot_command_name', fn.__name__)
 
+        def _on_match(ctx, msg, m):
+            user = message_context(ctx.bot, msg).mention
+            html = fn(ctx, user, msg.getBody(), match=m)
+            message_room(ctx, msg, html, color=color)
+
         @wraps(fn)
         def __status(ctx, msg, *args, **kwargs):
-            if not regex or not msg or not msg.getBody() or ctx.bot.from_bot(msg):
+            if not pattern or not msg or not msg.getBody() or ctx.bot.from_bot(msg):
                 return
             else:
-                m = re.search(regex, msg.getBody(), re.IGNORECASE)
+                m = pattern.search(msg.getBody())
                 if m:
-                    user = '@%s' % ctx.bot.get_sending_user(msg).mention_name
+                    user = message_context(ctx.bot, msg).mention
                     html = fn(ctx, user, msg.getBody(), match=m, **kwargs)
                     message_room(ctx, msg, html, color=color)
                 return
+        __status._hippybot_regex = pattern
+        __status._hippybot_on_match = _on_match
         return __status
 
     return _status
 
 
 def message_room(ctx, msg_obj, content, format='html', color='purple'):
-    channel = unicode(msg_obj.getFrom()).split('/')[0].split('@')[0].split('_', 1)[1]
-    room_id = sending_room = ctx.bot.get_sending_room(msg_obj).room_id
-    apiargs = {
-        'room_id': room_id,
-        'from': ctx.bot._config['connection']['nickname'],
-        'color': color,
-        'message_format': format,
-        'message': content
-    }
-    ctx.bot.api.rooms.message(apiargs)
-
+    """Queue a room notification, it's sent in the background by the bot's
+    notifier so this returns immediately.
+    """
+    room_id = message_context(ctx.bot, msg_obj).room.room_id
+    ctx.bot.notifier.notify(room_id, content,
+                            ctx.bot._config['connection']['nickname'],
+                            color=color, format=format)
@@ -0,0 +1,152 @@
+import re
+import logging
+
+# Python's re module refuses patterns with more than 100 groups, so regex
+# handlers are packed into as many combined patterns as needed to stay
+# under that limit.
+MAX_GROUPS = 99
+
+# Patterns using numbered or named back references can't be safely embedded
+# in a combined pattern, as their group numbering would shift.
+_BACKREF_RE = re.compile(r'\\[1-9]|\(\?P=')
+# Inline flags such as (?x) apply to the whole pattern they appear in, so
+# they would change how the other handlers of a combined pattern match.
+_INLINE_FLAGS_RE = re.compile(r'\(\?[iLmsux]+\)')
+
+log = logging.getLogger(__name__)
+
+
+class _Entry(object):
+    __slots__ = ('name', 'func', 'pattern', 'on_match', 'group', 'trigger')
+
+    def __init__(self, name, func):
+        self.name = name
+        self.func = func
+        self.pattern = getattr(func, '_hippybot_regex', None)
+        self.on_match = getattr(func, '_hippybot_on_match', None)
+        self.group = None
+        # Only the literal substrings of a @trigger are checked here, the
+        # RoutingTable takes care of its other conditions
+        trigger = getattr(func, '_hippybot_trigger', None)
+        self.trigger = trigger if trigger is not None and \
+            trigger.contains is not None else None
+
+
+class ContentDispatcher(object):
+    """Compiled index of content commands.
+
+    Handlers created with the @match and @status decorators expose their
+    compiled pattern, these are folded into combined patterns made of one
+    optional lookahead per handler, so a single match() call over the
+    message body reports every handler whose pattern hit. Only those
+    handlers (plus any plain @contentcmd handlers) are invoked.
+    """
+    def __init__(self, commands=()):
+        self._entries = []
+        self._scanners = []
+        self._fallback = []
+
+        regex_entries = []
+        for name, func in commands:
+            entry = _Entry(name, func)
+            self._entries.append(entry)
+            if entry.pattern is not None and entry.on_match is not None:
+                regex_entries.append(entry)
+        self._compile(regex_entries)
+
+    def _compile(self, entries):
+        # Patterns are only combined with others compiled with the same
+        # flags, as those change the meaning of e.g. \w and \b
+        batches = {}
+        for i, entry in enumerate(entries):
+            source = entry.pattern.pattern
+            if _BACKREF_RE.search(source) or _INLINE_FLAGS_RE.search(source):
+                self._fallback.append(entry)
+                continue
+            try:
+                piece = u'(?:(?=[\\s\\S]*?(?P<_h%d>%s))|)' % (i, source)
+            except UnicodeDecodeError:
+                self._fallback.append(entry)
+                continue
+            entry.group = '_h%d' % i
+            flags = entry.pattern.flags
+            pieces, groups = batches.get(flags, ([], 0))
+            size = entry.pattern.groups + 1
+            if pieces and groups + size > MAX_GROUPS:
+                self._add_scanner(pieces, flags)
+                pieces, groups = [], 0
+            pieces.append((entry, piece))
+            batches[flags] = pieces, groups + size
+        for flags, (pieces, _) in sorted(batches.iteritems()):
+            if pieces:
+                self._add_scanner(pieces, flags)
+
+    def _add_scanner(self, pieces, flags):
+        try:
+            scanner = re.compile(u''.join(p for _, p in pieces), flags)
+        except (re.error, AssertionError, OverflowError):
+            if len(pieces) == 1:
+                log.warn('Unable to index pattern for content command: %s',
+                         pieces[0][0].name)
+                self._fallback.append(pieces[0][0])
+                pieces[0][0].group = None
+                return
+            # Split the batch so one bad pattern doesn't knock the others
+            # off the fast path.
+            middle = len(pieces) // 2
+            self._add_scanner(pieces[:middle], flags)
+            self._add_scanner(pieces[middle:], flags)
+            return
+        self._scanners.append(scanner)
+
+    def scan(self, body):
+        """Returns the set of group names (or unindexed entries) whose
+        pattern matches body.
+        """
+        hits = set()
+        for scanner in self._scanners:
+            groupdict = scanner.match(body).groupdict()
+            for group, value in groupdict.iteritems():
+                if value is not None:
+                    hits.add(group)
+        for entry in self._fallback:
+            if entry.pattern.search(body):
+                hits.add(entry)
+        return hits
+
+    def handlers(self, mess, from_bot=None):
+        """Yields (name, handler) pairs, in registration order, for each
+        content command that should see the message. Each handler takes
+        the message as its only argument.
+
+        from_bot is an optional callable used to skip pattern handlers for
+        messages sent by the bot itself, it's only called if needed.
+        """
+        body = None
+        hits = None
+        for entry in self._entries:
+            if entry.trigger is not None:
+                if body is None:
+                    body = mess.getBody() or u''
+                if not entry.trigger.matches(body):
+                    continue
+            if entry.on_match is None:
+                yield entry.name, entry.func
+                continue
+            if hits is None:
+                body = mess.getBody()
+                if not body or (from_bot is not None and from_bot(mess)):
+                    hits = ()
+                else:
+                    hits = self.scan(body)
+            if entry.group in hits or entry in hits:
+                match = entry.pattern.search(body)
+                if match:
+                    yield entry.name, _bind(entry, match)
+
+
+def _bind(entry, match):
+    ctx = getattr(entry.func, '__self__', None)
+    def handler(mess):
+        return entry.on_match(ctx, mess, match)
+    return handler
@@ -0,0 +1,98 @@
+import time
+import logging
+import threading
+
+from hippybot.ratelimit import TokenBucket
+from hippybot.stats import STATS
+
+# (messages per second, burst) allowed per sender and per room for each kind
+# of message: commands addressed to the bot ("direct"), global commands that
+# fire without an @mention and everything else ("content", seen by the
+# content and all-message handlers). A rate of 0 disables the limit.
+DEFAULT_LIMITS = {
+    ('direct', 'user'): (0.5, 5),
+    ('direct', 'room'): (2, 10),
+    ('global', 'user'): (0.2, 3),
+    ('global', 'room'): (1, 5),
+    ('content', 'user'): (2, 20),
+    ('content', 'room'): (10, 50),
+}
+
+# Seconds between sweeps of the buckets of senders and rooms that have gone
+# quiet
+SWEEP_INTERVAL = 60
+
+log = logging.getLogger(__name__)
+
+
+class _Limit(object):
+    __slots__ = ('bucket', 'warned')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.warned = False
+
+
+class FloodControl(object):
+    """Inbound message limits, a token bucket per kind of message and
+    sender, and per kind of message and room.
+
+    check() is called for each message before any handler runs. A message
+    over either limit is dropped, and the first drop for a sender or room
+    is reported so the bot can ask them once to slow down. Buckets that
+    have refilled are swept away, which also re-arms that warning.
+    """
+    def __init__(self, limits=None, clock=time.time):
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._swept = clock()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _limit(self, kind, scope, key):
+        rate, burst = self.limits.get((kind, scope), (0, 0))
+        if not rate or key is None:
+            return None
+        with self._lock:
+            limit = self._buckets.get((kind, scope, key))
+            if limit is None:
+                limit = self._buckets[(kind, scope, key)] = _Limit(
+                    TokenBucket(rate, burst or rate, clock=self._clock))
+        return limit
+
+    def check(self, kind, user, room=None):
+        """Takes a token from the sender's and the room's buckets for kind.
+        Returns None if the message may be handled, otherwise the scope
+        ('user' or 'room') of the limit it's over and whether that's the
+        first drop since the bucket was last full, as a tuple.
+        """
+        now = self._clock()
+        if now - self._swept > SWEEP_INTERVAL:
+            self.sweep()
+        for scope, key in (('user', user), ('room', room)):
+            limit = self._limit(kind, scope, key)
+            if limit is None or not limit.bucket.try_consume():
+                continue
+            self.dropped += 1
+            STATS.incr('flood_dropped_total', kind=kind, scope=scope)
+            first, limit.warned = not limit.warned, True
+            if first:
+                log.warn('Dropping %s messages from %s %s, over %g/s',
+                         kind, scope, key, limit.bucket.rate)
+            return scope, first
+        return None
+
+    def sweep(self):
+        """Forget the buckets that have refilled.
+        """
+        with self._lock:
+            self._swept = self._clock()
+            full = [key for key, limit in self._buckets.iteritems()
+                    if limit.bucket.tokens >= limit.bucket.capacity]
+            for key in full:
+                del self._buckets[key]
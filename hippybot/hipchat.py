@@ -1,9 +1,19 @@
+import time
+import logging
 import requests
+from requests.adapters import HTTPAdapter
+try:
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    Retry = None
 try:
     import simplejson as json
 except ImportError:
     import json
 
+from hippybot.ratelimit import TokenBucket
+from hippybot.stats import STATS
+
 GETS = {
     'rooms': (
         'history', 'list', 'show'
@@ -23,21 +33,92 @@ POSTS = {
 }
 
 API_VERSION = '1'
-BASE_URL = 'https://api.hipchat.com/v%(version)s/%(section)s/%(method)s'
+API_PATH = '/v%(version)s/%(section)s/%(method)s'
+BASE_URL = 'https://api.hipchat.com' + API_PATH
+
+# Seconds to wait for a connection and a response
+DEFAULT_TIMEOUT = (5, 30)
+# Attempts made on connection errors and 5xx responses
+DEFAULT_RETRIES = 3
+DEFAULT_POOL_SIZE = 10
+# HipChat's v1 API allows 100 requests per 5 minutes per token
+DEFAULT_RATE_LIMIT = 100
+DEFAULT_RATE_PERIOD = 300
+# Seconds a request may wait for the rate limit before it fails, so callers
+# on the XMPP read loop aren't held up until the server's quota resets
+DEFAULT_THROTTLE_TIMEOUT = 5
+
+log = logging.getLogger(__name__)
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES):
+    """Returns a requests session with a keep-alive connection pool and
+    retries with backoff.
+    """
+    session = requests.Session()
+    if Retry is not None:
+        max_retries = Retry(total=retries, backoff_factor=0.5,
+                            status_forcelist=(500, 502, 503, 504))
+    else:
+        max_retries = retries
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=max_retries)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def base_url(root):
+    """Returns a HipChatApi base_url for an API root URL such as
+    http://127.0.0.1:8011, e.g. a local stand-in server.
+    """
+    if '%(' in root:
+        return root
+    return root.rstrip('/') + API_PATH
+
+
+class RateLimited(requests.RequestException):
+    """Raised when a request would have to wait longer than the throttle
+    timeout for the rate limit.
+    """
+
+
+def _header_int(headers, name):
+    try:
+        return int(headers[name])
+    except (KeyError, TypeError, ValueError):
+        return None
+
 
 class HipChatApi(object):
     """Lightweight Hipchat.com REST API wrapper
+
+    All section objects (e.g. ``api.rooms``) created from an instance share
+    its HTTP session and rate limit bucket.
     """
     def __init__(self, auth_token, name=None, gets=GETS, posts=POSTS,
-                base_url=BASE_URL, api_version=API_VERSION):
+                base_url=BASE_URL, api_version=API_VERSION, session=None,
+                timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                pool_size=DEFAULT_POOL_SIZE, rate_limit=DEFAULT_RATE_LIMIT,
+                rate_period=DEFAULT_RATE_PERIOD, bucket=None,
+                throttle_timeout=DEFAULT_THROTTLE_TIMEOUT):
         self._auth_token = auth_token
         self._name = name
         self._gets = gets
         self._posts = posts
         self._base_url = base_url
         self._api_version = api_version
+        self._timeout = timeout
+        self._session = session or create_session(pool_size, retries)
+        if bucket is None and rate_limit:
+            bucket = TokenBucket(float(rate_limit) / rate_period,
+                                 capacity=rate_limit)
+        self._bucket = bucket
+        self._throttle_timeout = throttle_timeout
+        self._sections = {}
 
-    def _request(self, method, params={}):
+    def _request(self, method, params=None):
+        params = dict(params or {})
         if 'auth_token' not in params:
             params['auth_token'] = self._auth_token
         url = self._base_url % {
@@ -46,18 +127,90 @@ class HipChatApi(object):
             'method': method
         }
         if method in self._gets[self._name]:
-            r = requests.get(url, params=params)
+            send = self._session.get
+            params = {'params': params}
         elif method in self._posts[self._name]:
-            r = requests.post(url, data=params)
+            send = self._session.post
+            params = {'data': params}
+        else:
+            raise AttributeError('Unknown HipChat API method: %s.%s' % (
+                self._name, method))
+        name = '%s.%s' % (self._name, method)
+        if self._bucket is not None:
+            with STATS.timer('api_throttled_seconds', method=name):
+                allowed = self._bucket.consume(timeout=self._throttle_timeout)
+            if not allowed:
+                STATS.incr('api_rate_limited_total', method=name)
+                raise RateLimited('HipChat API rate limit reached, %s not '
+                                  'sent' % name)
+        started = time.time()
+        try:
+            r = send(url, timeout=self._timeout, **params)
+        except requests.RequestException:
+            STATS.incr('api_errors_total', method=name)
+            raise
+        finally:
+            STATS.observe('api_seconds', time.time() - started, method=name)
+        STATS.incr('api_requests_total', method=name, status=r.status_code)
+        self._update_rate_limit(r)
         return json.loads(r.content)
 
+    def _update_rate_limit(self, response):
+        if self._bucket is None:
+            return
+        remaining = _header_int(response.headers, 'X-RateLimit-Remaining')
+        reset = _header_int(response.headers, 'X-RateLimit-Reset')
+        if remaining is None and response.status_code in (403, 429):
+            # Throttled without quota headers, back off for a while
+            remaining, reset = 0, time.time() + 30
+        if remaining is not None:
+            if remaining <= 0:
+                log.warn('HipChat API rate limit reached, requests paused '
+                         'until %s', reset)
+            self._bucket.update(remaining, reset)
+
     def __getattr__(self, attr_name):
+        if attr_name.startswith('_'):
+            raise AttributeError(attr_name)
         if self._name is None:
-            return super(HipChatApi, self).__self_class__(
-                auth_token=self._auth_token,
-                name=attr_name
-            )
+            section = self._sections.get(attr_name)
+            if section is None:
+                section = self.__class__(
+                    auth_token=self._auth_token,
+                    name=attr_name,
+                    gets=self._gets,
+                    posts=self._posts,
+                    base_url=self._base_url,
+                    api_version=self._api_version,
+                    session=self._session,
+                    timeout=self._timeout,
+                    bucket=self._bucket,
+                    rate_limit=None,
+                    throttle_timeout=self._throttle_timeout
+                )
+                self._sections[attr_name] = section
+            return section
         else:
             def wrapper(*args, **kwargs):
                 return self._request(attr_name, *args, **kwargs)
             return wrapper
+
+
+def api_from_config(hipchat):
+    """Returns a HipChatApi configured by the [hipchat] section of the config
+    file, or False if there's no API token.
+    """
+    auth_token = hipchat.get('api_auth_token', None)
+    if auth_token is None:
+        return False
+    kwargs = {}
+    if hipchat.get('api_base_url'):
+        kwargs['base_url'] = base_url(hipchat['api_base_url'])
+    if 'api_timeout' in hipchat:
+        kwargs['timeout'] = float(hipchat['api_timeout'])
+    if 'api_throttle_timeout' in hipchat:
+        kwargs['throttle_timeout'] = float(hipchat['api_throttle_timeout'])
+    for opt in ('retries', 'pool_size', 'rate_limit', 'rate_period'):
+        if 'api_%s' % opt in hipchat:
+            kwargs[opt] = int(hipchat['api_%s' % opt])
+    return HipChatApi(auth_token=auth_token, **kwargs)
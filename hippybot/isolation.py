@@ -0,0 +1,622 @@
+import os
+import sys
+import time
+import struct
+import logging
+import itertools
+import threading
+import traceback
+import subprocess
+import cPickle as pickle
+from inspect import ismethod
+from Queue import Queue, Empty
+
+from jabberbot import xmpp
+
+from hippybot.context import MessageContext, message_context
+from hippybot.hipchat import api_from_config
+from hippybot.stats import STATS
+
+# Worker processes started for each isolated plugin
+DEFAULT_PROCESSES = 1
+# Seconds a call may take before its worker process is killed
+DEFAULT_TIMEOUT = 30
+# Seconds a new worker process has to import the plugin and report ready
+START_TIMEOUT = 30
+
+# Context values resolved by the bot and sent along with each message, so
+# the worker never has to look them up
+CONTEXT_FIELDS = ('body', 'to_bot', 'message', 'command', 'is_groupchat',
+                  'room_name', 'user', 'room', 'mention', 'from_bot')
+# Bucket methods a worker can call on the bot's storage
+BUCKET_METHODS = ('get', 'set', 'delete', 'incr', 'pop', 'items')
+
+_HEADER = struct.Struct('!I')
+
+log = logging.getLogger(__name__)
+
+
+class IsolationError(Exception):
+    """A call to an isolated plugin failed because its worker process died,
+    took too long or couldn't be started.
+    """
+
+
+class RemoteError(Exception):
+    """A call raised an exception in the other process, e.g. a plugin
+    handler in its worker process, the message is the formatted traceback.
+    """
+
+
+def _send(fd, obj):
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    data = _HEADER.pack(len(data)) + data
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _read(fd, size):
+    chunks = []
+    while size:
+        chunk = os.read(fd, size)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+
+def _recv(fd):
+    size, = _HEADER.unpack(_read(fd, _HEADER.size))
+    return pickle.loads(_read(fd, size))
+
+
+class _Channel(object):
+    """Writing end of a pipe between the bot and a worker process. Frames
+    can be sent from any thread, each is written whole.
+    """
+    def __init__(self, fd):
+        self.fd = fd
+        self._lock = threading.Lock()
+
+    def send(self, obj):
+        with self._lock:
+            _send(self.fd, obj)
+
+
+def pack_message(bot, mess):
+    """Serialises a message and its context to be sent to a worker.
+    """
+    ctx = message_context(bot, mess)
+    values = {}
+    for field in CONTEXT_FIELDS:
+        if field == 'room' and not ctx.is_groupchat:
+            continue
+        values[field] = getattr(ctx, field)
+    return unicode(mess).encode('utf-8'), values
+
+
+def unpack_message(bot, packed, call=None):
+    xml, values = packed
+    mess = xmpp.Message(node=xml)
+    # The call the message arrived with, replies to it while that call is
+    # running are sent in order with its result
+    mess.isolation_call = call
+    ctx = mess.context = MessageContext(bot, mess)
+    ctx.__dict__.update(values)
+    if 'room' not in values:
+        ctx.room = None
+    mess.to_bot = ctx.to_bot
+    return mess
+
+
+class _Worker(object):
+    """A worker process running one isolated plugin, see main().
+
+    A reader thread takes every frame the worker sends. Results of calls,
+    and messages sent by the handler while it runs, are passed to the
+    calling thread. Messages sent outside a call, e.g. from a timer, are
+    passed on to the bot straight away and storage calls are run on the
+    bot's storage.
+    """
+    def __init__(self, bot, path):
+        self.bot = bot
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(p for p in sys.path if p)
+        self.process = subprocess.Popen(
+            [sys.executable, '-m', 'hippybot.isolation'],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True,
+            env=env)
+        self._in = self.process.stdout.fileno()
+        self._channel = _Channel(self.process.stdin.fileno())
+        self._calls = itertools.count()
+        self._results = Queue()
+        self._reader = threading.Thread(target=self._read,
+                                        name='hippybot-isolation-reader')
+        self._reader.daemon = True
+        self._reader.start()
+        try:
+            self._channel.send(('init', path, bot._config))
+            reply = self._wait(time.time() + START_TIMEOUT)
+        except (IOError, OSError, IsolationError), e:
+            self.kill()
+            raise IsolationError('Unable to start worker for %s: %s' % (
+                path, e))
+        if reply[0] != 'ready':
+            self.kill()
+            raise IsolationError('Unable to load %s in a worker: %s' % (
+                path, reply[1]))
+        self.all_msg_handlers = reply[1]
+
+    @property
+    def alive(self):
+        return self.process.poll() is None
+
+    def _read(self):
+        try:
+            while True:
+                frame = _recv(self._in)
+                op = frame[0]
+                if op == 'storage':
+                    self._storage(*frame[1:])
+                elif op == 'notify':
+                    self._notify(*frame[1:])
+                elif op in ('ready', 'result', 'error') or \
+                        frame[1] is not None:
+                    self._results.put(frame)
+                else:
+                    self._deliver(frame)
+        except (EOFError, IOError, OSError):
+            pass
+        except Exception, e:
+            log.exception('Error reading from worker process: %s', e)
+            self.kill()
+        self._results.put(('exited', self.process.wait()))
+
+    def _storage(self, request, bucket, method, args, kwargs):
+        try:
+            if method not in BUCKET_METHODS:
+                raise AttributeError('Unknown storage method: %s' % method)
+            value = getattr(self.bot.storage.bucket(bucket), method)(
+                *args, **kwargs)
+            reply = ('storage', request, True, value)
+        except Exception:
+            reply = ('storage', request, False, traceback.format_exc())
+        try:
+            self._channel.send(reply)
+        except (IOError, OSError):
+            pass
+
+    def _notify(self, args, kwargs):
+        try:
+            notifier = self.bot.notifier
+            if notifier is None:
+                log.warn('Dropped room notification from worker process, '
+                         'there is no HipChat API token')
+            else:
+                notifier.notify(*args, **kwargs)
+        except Exception, e:
+            log.exception('Unable to queue notification from worker '
+                          'process: %s', e)
+
+    def _deliver(self, frame, mess=None):
+        """Pass a message sent by the plugin on to the bot. mess is the
+        message of the call it was sent during, if any.
+        """
+        try:
+            op = frame[0]
+            if op == 'reply':
+                if mess is None:
+                    mess = xmpp.Message(node=frame[2])
+                self.bot.send_simple_reply(mess, frame[3], frame[4])
+            elif op == 'send':
+                self.bot.send(frame[2], frame[3], message_type=frame[4])
+            elif op == 'stanza':
+                self.bot.send_message(xmpp.Message(node=frame[2]))
+        except Exception, e:
+            log.exception('Unable to send %s from worker process: %s',
+                          frame[0], e)
+
+    def _wait(self, deadline):
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise IsolationError('Timed out')
+        try:
+            frame = self._results.get(timeout=timeout)
+        except Empty:
+            raise IsolationError('Timed out')
+        if frame[0] == 'exited':
+            # Let later waits see it too
+            self._results.put(frame)
+            raise IsolationError('Worker process exited with %s' % frame[1])
+        return frame
+
+    def call(self, kind, attr, mess, args, timeout):
+        """Runs a handler of the plugin and returns its result. Replies the
+        handler sends meanwhile are passed on to the bot as they arrive.
+        """
+        deadline = time.time() + timeout if timeout else None
+        call = next(self._calls)
+        try:
+            self._channel.send(('call', call, kind, attr,
+                                pack_message(self.bot, mess), args))
+        except (IOError, OSError), e:
+            raise IsolationError('Lost worker process: %s' % e)
+        while True:
+            frame = self._wait(deadline)
+            op = frame[0]
+            if op == 'result':
+                return frame[1]
+            elif op == 'error':
+                raise RemoteError(frame[1])
+            else:
+                self._deliver(frame, mess)
+
+    def stop(self):
+        try:
+            self._channel.send(('stop',))
+        except (IOError, OSError):
+            pass
+        self.process.stdin.close()
+        self._reader.join(1)
+
+    def kill(self):
+        if self.alive:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+        self.process.wait()
+
+
+class IsolatedPlugin(object):
+    """Runs a plugin's handlers in a pool of worker processes.
+
+    The bot registers a proxy for each command and content command of the
+    plugin's class (see proxy()), calling one sends the message and its
+    context to an idle worker, which runs the real handler and streams any
+    replies back before its result. Workers that die or take longer than
+    timeout seconds are killed and replaced, the call failing with an
+    IsolationError.
+    """
+    def __init__(self, bot, path, processes=DEFAULT_PROCESSES,
+                 timeout=DEFAULT_TIMEOUT):
+        self.bot = bot
+        self.path = path
+        self.name = path.split('.')[-1]
+        self.timeout = timeout
+        self.restarts = 0
+        self._closed = False
+        self._idle = Queue()
+        self.all_msg_handlers = ()
+        # Start them all up front, so a plugin that can't be loaded fails
+        # the registration rather than its first call
+        workers = []
+        try:
+            for _ in range(max(processes, 1)):
+                workers.append(_Worker(bot, path))
+        except IsolationError:
+            for worker in workers:
+                worker.kill()
+            raise
+        self.all_msg_handlers = workers[0].all_msg_handlers
+        for worker in workers:
+            self._idle.put(worker)
+        self.processes = len(workers)
+
+    def _restart(self):
+        self.restarts += 1
+        STATS.incr('isolated_restarts_total', plugin=self.name)
+        return _Worker(self.bot, self.path)
+
+    def call(self, kind, attr, mess, args=None):
+        worker = self._idle.get()
+        if self._closed:
+            # Pass it on to any other call waiting for a worker
+            self._idle.put(worker)
+            raise IsolationError('%s has been unloaded' % self.name)
+        if worker is None or not worker.alive:
+            # A worker died earlier and couldn't be replaced then
+            try:
+                worker = self._restart()
+            except IsolationError:
+                self._idle.put(None)
+                raise
+        try:
+            return worker.call(kind, attr, mess, args, self.timeout)
+        except IsolationError, e:
+            log.error('Worker for %s failed running %s, restarting it: %s',
+                      self.name, attr, e)
+            STATS.incr('isolated_failures_total', plugin=self.name)
+            worker.kill()
+            worker = None
+            if not self._closed:
+                threading.Thread(target=self._replace,
+                                 name='hippybot-isolation-restart').start()
+            raise
+        finally:
+            if worker is not None:
+                if self._closed:
+                    worker.stop()
+                    self._idle.put(None)
+                else:
+                    self._idle.put(worker)
+
+    def _replace(self):
+        try:
+            worker = self._restart()
+        except IsolationError, e:
+            log.error('%s', e)
+            worker = None
+        self._idle.put(worker)
+
+    def proxy(self, attr, method):
+        """Returns a function standing in for a handler of the plugin's
+        class, with the same command attributes, which calls it in a
+        worker.
+        """
+        if getattr(method, '_jabberbot_command', False):
+            def handler(mess, args):
+                return self.call('command', attr, mess, args)
+        else:
+            def handler(mess):
+                return self.call('content', attr, mess)
+        handler.__name__ = attr
+        handler.__doc__ = method.__doc__
+        for key, value in vars(method.__func__).iteritems():
+            if key.startswith(('_jabberbot_', '_hippybot_')):
+                setattr(handler, key, value)
+        if getattr(method, '_hippybot_on_match', None) is not None:
+            # The worker matches the pattern again, the bot's match only
+            # spares it the messages that can't match
+            handler._hippybot_on_match = lambda ctx, mess, match: \
+                handler(mess)
+        return handler
+
+    def all_msg_proxies(self):
+        proxies = []
+        for index, name in enumerate(self.all_msg_handlers):
+            def handler(mess, index=index):
+                return self.call('all_msg', index, mess)
+            handler.__name__ = name
+            proxies.append(handler)
+        return proxies
+
+    def close(self):
+        """Stop the workers, busy ones once their call returns.
+        """
+        self._closed = True
+        while not self._idle.empty():
+            worker = self._idle.get()
+            if worker is not None:
+                worker.stop()
+        # Wakes calls waiting for a worker, so they fail
+        self._idle.put(None)
+
+
+class _StorageProxy(object):
+    """Stands in for the bot's storage in a worker process. Every call is
+    made on the bot's own storage, so the bot and all of a plugin's
+    workers see the same data.
+    """
+    def __init__(self, channel):
+        self._channel = channel
+        self._lock = threading.Lock()
+        self._requests = itertools.count()
+        self._waiting = {}
+        self._closed = False
+
+    def bucket(self, name):
+        return _BucketProxy(self, name)
+
+    def call(self, bucket, method, args, kwargs):
+        slot = Queue()
+        with self._lock:
+            if self._closed:
+                raise IsolationError('Lost the bot process')
+            request = next(self._requests)
+            self._waiting[request] = slot
+        self._channel.send(('storage', request, bucket, method, args, kwargs))
+        ok, value = slot.get()
+        if not ok:
+            raise RemoteError(value)
+        return value
+
+    def answer(self, request, ok, value):
+        with self._lock:
+            slot = self._waiting.pop(request, None)
+        if slot is not None:
+            slot.put((ok, value))
+
+    def close(self):
+        """Fail the calls waiting for an answer.
+        """
+        with self._lock:
+            self._closed = True
+            waiting, self._waiting = self._waiting, {}
+        for slot in waiting.itervalues():
+            slot.put((False, 'Lost the bot process'))
+
+
+def _bucket_method(method):
+    def call(self, *args, **kwargs):
+        return self._storage.call(self.name, method, args, kwargs)
+    call.__name__ = method
+    return call
+
+
+class _BucketProxy(object):
+    """Stands in for a storage Bucket in a worker process.
+    """
+    def __init__(self, storage, name):
+        self._storage = storage
+        self.name = name
+
+    get = _bucket_method('get')
+    set = _bucket_method('set')
+    delete = _bucket_method('delete')
+    incr = _bucket_method('incr')
+    pop = _bucket_method('pop')
+    items = _bucket_method('items')
+
+
+class _NotifierProxy(object):
+    """Stands in for the bot's notifier in a worker process, notifications
+    are passed to the bot to queue.
+    """
+    def __init__(self, channel):
+        self._channel = channel
+
+    def notify(self, *args, **kwargs):
+        self._channel.send(('notify', args, kwargs))
+
+
+class WorkerBot(object):
+    """Stands in for the bot in a worker process.
+
+    It provides the config, a log, the HipChat API, storage (calls are
+    made on the bot's storage), the notifier and ways to send messages,
+    which are passed back to the bot. Messages sent while a handler is running are sent in
+    order with its result, those sent from other threads (e.g. a timer)
+    straight away.
+    """
+    def __init__(self, config, name, channel):
+        self._config = config
+        self._channel = channel
+        self._local = threading.local()
+        self.log = logging.getLogger('hippybot.plugins.%s' % name)
+        self._api = None
+        self.storage = _StorageProxy(channel)
+        self.notifier = _NotifierProxy(channel)
+
+    def _call(self, mess=None):
+        """The call to send a message with, None if it's not sent by a
+        running handler (in reply to its own message).
+        """
+        call = getattr(self._local, 'call', None)
+        if mess is not None and getattr(mess, 'isolation_call', None) != call:
+            return None
+        return call
+
+    def from_bot(self, mess):
+        return message_context(self, mess).from_bot
+
+    def to_bot(self, mess):
+        ctx = message_context(self, mess)
+        return ctx.to_bot, ctx.message
+
+    def get_sending_user(self, mess):
+        return message_context(self, mess).user
+
+    def get_sending_room(self, mess):
+        return message_context(self, mess).room
+
+    def send_simple_reply(self, mess, text, private=False):
+        call = self._call(mess)
+        # Replies made outside their call carry the message they answer
+        xml = unicode(mess).encode('utf-8') if call is None else None
+        self._channel.send(('reply', call, xml, text, private))
+
+    def send(self, user, text, in_reply_to=None, message_type='chat'):
+        self._channel.send(('send', self._call(), unicode(user), text,
+                            message_type))
+
+    def send_message(self, mess):
+        self._channel.send(('stanza', self._call(),
+                            unicode(mess).encode('utf-8')))
+
+    @property
+    def api(self):
+        if self._api is None:
+            self._api = api_from_config(self._config.get('hipchat', {}))
+        return self._api
+
+
+def _read_requests(fd, bot, requests):
+    """Reader thread of a worker process, answers to storage calls are
+    passed to the waiting thread and everything else to the main loop.
+    """
+    try:
+        while True:
+            frame = _recv(fd)
+            if frame[0] == 'storage':
+                bot.storage.answer(*frame[1:])
+            else:
+                requests.put(frame)
+    except EOFError:
+        pass
+    bot.storage.close()
+    requests.put(('stop',))
+
+
+def main():
+    """Worker process entry point, loads the plugin named by the bot and
+    runs its handlers on request until told to stop.
+    """
+    # Messages to the bot go through the original stdout, anything plugins
+    # print goes to stderr instead
+    channel = _Channel(os.dup(1))
+    os.dup2(2, 1)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s '
+                        '[%(process)d] %(name)s %(levelname)s %(message)s')
+    _, path, config = _recv(0)
+    name = path.split('.')[-1]
+    bot = WorkerBot(config, name, channel)
+    requests = Queue()
+    reader = threading.Thread(target=_read_requests, args=(0, bot, requests),
+                              name='hippybot-isolation-reader')
+    reader.daemon = True
+    reader.start()
+    try:
+        module = __import__(path, fromlist=['Plugin'])
+        plugin = module.Plugin()
+        plugin.bot = bot
+        handlers = {}
+        for attr in dir(plugin):
+            method = getattr(plugin, attr)
+            if ismethod(method) and (
+                    getattr(method, '_jabberbot_command', False) or
+                    getattr(method, '_jabberbot_content_command', False)):
+                handlers[attr] = method
+        all_msg_handlers = list(getattr(plugin, 'all_msg_handlers', ()))
+    except Exception:
+        channel.send(('error', traceback.format_exc()))
+        return 1
+    channel.send(('ready', [getattr(handler, '__name__', 'handler')
+                            for handler in all_msg_handlers]))
+    while True:
+        request = requests.get()
+        if request[0] == 'stop':
+            break
+        _, call, kind, attr, packed, args = request
+        bot._local.call = call
+        try:
+            mess = unpack_message(bot, packed, call)
+            if kind == 'command':
+                result = handlers[attr](mess, args)
+            elif kind == 'content':
+                result = handlers[attr](mess)
+            else:
+                result = all_msg_handlers[attr](mess)
+            if result is not None and not isinstance(result, basestring):
+                result = unicode(result)
+            channel.send(('result', result))
+        except Exception:
+            channel.send(('error', traceback.format_exc()))
+        finally:
+            bot._local.call = None
+    teardown = getattr(plugin, 'teardown', None)
+    if teardown is not None:
+        try:
+            teardown()
+        except Exception, e:
+            log.exception('Error tearing down %s: %s', path, e)
+    # The bot closes the pipe after asking us to stop
+    reader.join(1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
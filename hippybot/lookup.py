@@ -1,5 +1,14 @@
+import os
+import os.path
+import time
+import marshal
+import logging
+import threading
+from Queue import Queue, Empty
 from xmpp.protocol import JID
 
+from hippybot.stats import STATS
+
 USER_DOMAIN = "chat.hipchat.com"
 ROOM_DOMAIN = "conf.hipchat.com"
 
@@ -9,51 +18,370 @@ def _extract_hipchat_account_prefix_id(bot):
 def _create_xmpp_jid_for_user(prefix_id, user_id):
     return '%s_%s@%s' % (prefix_id, user_id, USER_DOMAIN)
 
+# Seconds before a cached user or room is revalidated against the API
+DEFAULT_TTL = 3600
+# Seconds between background syncs of the full user and room lists
+DEFAULT_REFRESH_INTERVAL = 900
+# Minimum seconds between syncs triggered by unknown senders
+DEFAULT_MISS_INTERVAL = 60
+# File the user and room lists are saved to, so a restart can use them
+# straight away
+DEFAULT_SNAPSHOT_PATH = os.path.expanduser('~/.hippybot/lookup.snapshot')
+SNAPSHOT_VERSION = 1
+
+log = logging.getLogger(__name__)
+
+class SyncError(Exception):
+    """Raised when HipChat answers a list call with an error (e.g. its 403
+    rate limit reply) instead of the list.
+    """
+
+def _listing(response, key):
+    """Returns the list under key of a users.list or rooms.list response,
+    raising SyncError if the response doesn't hold one. An error must not
+    be mistaken for an empty list, which would empty the cache.
+    """
+    items = response.get(key) if isinstance(response, dict) else None
+    if not isinstance(items, list) or 'error' in response:
+        error = response.get('error') if isinstance(response, dict) \
+            else response
+        raise SyncError('Unable to list %s: %r' % (key, error))
+    return items
+
 class Lookup(object):
+    """Cache of HipChat users and rooms.
+
+    The first access loads the full lists, after that a background thread
+    periodically fetches them again and merges them with what's cached,
+    so lookups never see an empty cache. Records are indexed by JID, id,
+    name and mention name. Entries older than
+    their TTL are revalidated individually, and unknown 1-1 chat senders are
+    fetched on their own via users.show.
+
+    prefetch() loads both lists in background threads, so that can overlap
+    with the rest of the bot's startup.
+
+    After each successful full sync the lists are written to a snapshot
+    file. On start up the snapshot, if there is one, is loaded instead and
+    a sync is scheduled to revalidate it in the background, so the bot
+    doesn't have to wait on the API before it can resolve senders.
+    """
     def __init__(self, bot):
         self._bot = bot
         self._hipchat_account_prefix_id = _extract_hipchat_account_prefix_id(bot)
+        hipchat = bot._config.get('hipchat', {})
+        self._ttl = float(hipchat.get('lookup_ttl', DEFAULT_TTL))
+        self._refresh_interval = float(hipchat.get(
+            'lookup_refresh_interval', DEFAULT_REFRESH_INTERVAL))
+        self._miss_interval = float(hipchat.get(
+            'lookup_miss_interval', DEFAULT_MISS_INTERVAL))
+        self._lock = threading.RLock()
+        # Initial loads of each list have their own lock, so users and rooms
+        # can be fetched at the same time
+        self._user_lock = threading.Lock()
+        self._room_lock = threading.Lock()
+        self.load_times = {}
+        self._snapshot_path = os.path.expanduser(hipchat.get(
+            'lookup_snapshot', DEFAULT_SNAPSHOT_PATH))
+        self._snapshot_lock = threading.Lock()
+        # Number of users and rooms in the snapshot file, as last loaded or
+        # saved
+        self._snapshot_sizes = None
+        self._tasks = Queue()
+        self._queued = set()
+        self._refresher = None
+        self._last_sync = 0
+        self._unknown = {}
+        self.load_snapshot()
+
+    def prefetch(self):
+        """Start loading the user and room lists in background threads and
+        return immediately. Lookups made before a list has arrived wait for
+        it rather than fetching it again.
+        """
+        threads = []
+        for kind, load in (('users', self._users), ('rooms', self._rooms)):
+            if getattr(self, '_%s_index' % kind[:-1]) is not None:
+                continue
+            thread = threading.Thread(target=self._prefetch, args=(kind, load),
+                                      name='hippybot-prefetch-%s' % kind)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        return threads
+
+    def _prefetch(self, kind, load):
+        try:
+            index = load()
+        except Exception, e:
+            # Left unloaded, the next lookup will try again
+            log.exception('Unable to prefetch %s: %s', kind, e)
+        else:
+            log.info('Loaded %d %s in %.2fs', len(index.records()), kind,
+                     self.load_times.get(kind, 0))
+            self.save_snapshot()
+
+    def load_snapshot(self):
+        """Fill the cache from the snapshot file, returns True if it was
+        loaded.
+        """
+        if not self._snapshot_path or not os.path.exists(self._snapshot_path):
+            return False
+        started = time.time()
+        try:
+            with open(self._snapshot_path, 'rb') as f:
+                snapshot = marshal.load(f)
+            if snapshot.get('version') != SNAPSHOT_VERSION:
+                return False
+            users = _thaw(User, USER_KEYS, *snapshot['users'])
+            rooms = _thaw(Room, ROOM_KEYS, *snapshot['rooms'])
+        except Exception, e:
+            log.warn('Unable to load lookup snapshot %s: %s',
+                     self._snapshot_path, e)
+            return False
+        if users is None or rooms is None:
+            # Saved by a version with different fields
+            return False
+        with self._lock:
+            self._user_index, self._room_index = users, rooms
+        self._snapshot_sizes = (len(users.records()), len(rooms.records()))
+        # Revalidate it in the background
+        self.refresh()
+        log.info('Loaded %d users and %d rooms from %s in %.3fs, saved %ds '
+                 'ago', len(users.records()), len(rooms.records()),
+                 self._snapshot_path, time.time() - started,
+                 time.time() - snapshot.get('saved_at', 0))
+        return True
+
+    def save_snapshot(self):
+        """Write the cached users and rooms to the snapshot file. The file
+        is written under a temporary name and renamed, so it's replaced
+        atomically. A snapshot holding users or rooms is never replaced by
+        one without any.
+        """
+        users, rooms = self._user_index, self._room_index
+        if not self._snapshot_path or users is None or rooms is None:
+            return False
+        sizes = (len(users.records()), len(rooms.records()))
+        if self._snapshot_sizes is not None and any(
+                old and not new for old, new in zip(self._snapshot_sizes,
+                                                    sizes)):
+            log.warn('Not saving lookup snapshot %s, %d users and %d rooms '
+                     'would replace %d users and %d rooms',
+                     self._snapshot_path, *(sizes + self._snapshot_sizes))
+            return False
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'saved_at': time.time(),
+            'users': _freeze(User, users),
+            'rooms': _freeze(Room, rooms),
+        }
+        with self._snapshot_lock:
+            tmp = '%s.tmp' % self._snapshot_path
+            try:
+                directory = os.path.dirname(self._snapshot_path)
+                if directory and not os.path.exists(directory):
+                    os.makedirs(directory)
+                with open(tmp, 'wb') as f:
+                    marshal.dump(snapshot, f)
+                os.rename(tmp, self._snapshot_path)
+            except (IOError, OSError, ValueError), e:
+                log.warn('Unable to save lookup snapshot %s: %s',
+                         self._snapshot_path, e)
+                return False
+            self._snapshot_sizes = sizes
+        return True
 
     def refresh(self):
-        self._rooms = None
-        self._rooms_by_channel = None
-        self._users = None
-        self._users_by_name = None
+        """Schedule a background sync of the user and room lists, existing
+        entries stay available until it has been merged in.
+        """
+        self._schedule(('sync',))
+
+    def _schedule(self, task):
+        with self._lock:
+            if task in self._queued:
+                return
+            self._queued.add(task)
+            self._start_refresher()
+        self._tasks.put(task)
+
+    def _start_refresher(self):
+        with self._lock:
+            if self._refresher is None:
+                self._refresher = threading.Thread(target=self._run_refresher,
+                                                   name='hippybot-lookup')
+                self._refresher.daemon = True
+                self._refresher.start()
+
+    def _run_refresher(self):
+        while True:
+            try:
+                task = self._tasks.get(timeout=self._refresh_interval)
+            except Empty:
+                task = ('sync',)
+            else:
+                with self._lock:
+                    self._queued.discard(task)
+            try:
+                if task[0] == 'sync':
+                    self.sync()
+                elif task[0] == 'user':
+                    self.fetch_user(task[1])
+                elif task[0] == 'room':
+                    self.fetch_room(task[1])
+            except Exception, e:
+                log.exception('Lookup refresh %r failed: %s', task, e)
+
+    def sync(self):
+        """Fetch the full user and room lists and merge them into the
+        existing maps. Raises SyncError, leaving the cache and snapshot as
+        they were, if either list can't be fetched.
+        """
+        self._last_sync = time.time()
+        rooms = _listing(self._bot.api.rooms.list(), 'rooms')
+        users = _listing(self._bot.api.users.list(), 'users')
+        self._merge_rooms(rooms, complete=True)
+        self._merge_users(users, complete=True)
+        self.save_snapshot()
+
+    def _merge_rooms(self, items, complete=False):
+        records = [Room.from_data(item) for item in items]
+        self._room_index = self._merge(self._room_index, records, ROOM_KEYS,
+                                       complete)
+
+    def _merge_users(self, items, complete=False):
+        records = []
+        for user_item in items:
+            # Note: xmpp_jid not expressly provided: one must map to raw roster by resource name
+            user_item['xmpp_jid'] = _create_xmpp_jid_for_user(self._hipchat_account_prefix_id, user_item.get('user_id'))
+            records.append(User.from_data(user_item))
+        self._user_index = self._merge(self._user_index, records, USER_KEYS,
+                                       complete)
+
+    def _merge(self, index, records, keys, complete):
+        now = time.time()
+        for record in records:
+            record.fetched_at = now
+        with self._lock:
+            if index is not None and not complete:
+                index.extend(records)
+                return index
+            # Full lists are indexed in one pass into fresh maps, which are
+            # swapped in whole so readers never see a partial index. Records
+            # that haven't changed are carried over rather than replaced.
+            if index is not None:
+                previous = index.maps[index.primary]
+                for i, record in enumerate(records):
+                    old = previous.get(getattr(record, index.primary))
+                    if old is not None and old.same_as(record):
+                        old.fetched_at = now
+                        records[i] = old
+            fresh = Index(keys)
+            fresh.extend(records)
+            return fresh
+
+    def fetch_user(self, user_id):
+        """Fetch a single user via users.show and merge it into the cache,
+        returns the user or None if HipChat doesn't know it.
+        """
+        data = self._bot.api.users.show({'user_id': user_id}).get('user')
+        if not data:
+            return None
+        self._merge_users([data])
+        return self.users().get(_create_xmpp_jid_for_user(
+            self._hipchat_account_prefix_id, data.get('user_id')))
+
+    def fetch_room(self, room_id):
+        """Fetch a single room via rooms.show and merge it into the cache.
+        """
+        data = self._bot.api.rooms.show({'room_id': room_id}).get('room')
+        if not data:
+            return None
+        self._merge_rooms([data])
+        return self.rooms().get(data.get('xmpp_jid'))
+
+    def _check_fresh(self, kind, record):
+        if record is not None and \
+                time.time() - (record.fetched_at or 0) > self._ttl:
+            self._schedule((kind, getattr(record, '%s_id' % kind)))
+        return record
+
+    def _missed(self):
+        if time.time() - self._last_sync > self._miss_interval:
+            self._last_sync = time.time()
+            self.refresh()
+
+    _room_index = None
+    def _rooms(self):
+        if self._room_index is None:
+            with self._room_lock:
+                if self._room_index is None:
+                    started = self._last_sync = time.time()
+                    self._merge_rooms(
+                        _listing(self._bot.api.rooms.list(), 'rooms'))
+                    self.load_times['rooms'] = time.time() - started
+                    self._start_refresher()
+        return self._room_index
 
-    _rooms = None
     def rooms(self):
-        if self._rooms is None:
-            self._rooms = {}
-            for item in self._bot.api.rooms.list().get('rooms', []):
-                room = Room.from_data(item)
-                self._rooms[room.xmpp_jid] = room
-        return self._rooms
+        """Rooms keyed by XMPP JID.
+        """
+        return self._rooms().maps['xmpp_jid']
+
+    def rooms_by_id(self):
+        return self._rooms().maps['room_id']
+
+    def room_for_id(self, room_id):
+        return self.rooms_by_id().get(_coerce_id(room_id))
 
     def room_for_jid(self, from_jid):
         from_jid = self.normalize_jid(from_jid)
         if self.is_groupchat(from_jid):
-            return self.rooms().get(from_jid.getStripped())
+            room = self.rooms().get(from_jid.getStripped())
+            if room is None:
+                STATS.incr('lookup_total', kind='room', result='miss')
+                self._missed()
+            else:
+                STATS.incr('lookup_total', kind='room', result='hit')
+            return self._check_fresh('room', room)
         else:
             return None
 
-    _users = None
+    _user_index = None
+    def _users(self):
+        if self._user_index is None:
+            with self._user_lock:
+                if self._user_index is None:
+                    started = self._last_sync = time.time()
+                    self._merge_users(
+                        _listing(self._bot.api.users.list(), 'users'))
+                    self.load_times['users'] = time.time() - started
+                    self._start_refresher()
+        return self._user_index
+
     def users(self):
-        if self._users is None:
-            self._users = {}
-            for user_item in self._bot.api.users.list().get('users', []):
-                # Note: xmpp_jid not expressly provided: one must map to raw roster by resource name
-                user_item['xmpp_jid'] = _create_xmpp_jid_for_user(self._hipchat_account_prefix_id, user_item.get('user_id'))
-                user = User.from_data(user_item)
-                self._users[user.xmpp_jid] = user
-        return self._users
-
-    _users_by_name = None
+        """Users keyed by XMPP JID.
+        """
+        return self._users().maps['xmpp_jid']
+
     def users_by_name(self):
-        if self._users_by_name is None:
-            self._users_by_name = {}
-            for user in self.users().itervalues():
-                self._users_by_name[user.name] = user
-        return self._users_by_name
+        return self._users().maps['name']
+
+    def users_by_mention(self):
+        """Users keyed by lower cased mention name.
+        """
+        return self._users().maps['mention_name']
+
+    def users_by_id(self):
+        return self._users().maps['user_id']
+
+    def user_for_mention(self, mention_name):
+        return self.users_by_mention().get(
+            _lower(mention_name.lstrip(u'@')))
+
+    def user_for_id(self, user_id):
+        return self.users_by_id().get(_coerce_id(user_id))
 
     def is_groupchat(self, jid):
         return ROOM_DOMAIN == self.normalize_jid(jid).getDomain()
@@ -74,33 +402,175 @@ class Lookup(object):
         from_jid = self.normalize_jid(from_jid)
         if self.is_groupchat(from_jid):
             nickname = from_jid.getResource()
-            return self.users_by_name().get(nickname)
+            user = self.users_by_name().get(nickname)
+            result = 'hit'
+            if user is None:
+                result = 'miss'
+                self._missed()
         else:
             stripped = from_jid.getStripped()
-            return self.users().get(stripped)
+            user = self.users().get(stripped)
+            result = 'hit'
+            if user is None:
+                user = self._fetch_unknown_user(from_jid)
+                result = 'miss' if user is None else 'fetched'
+        STATS.incr('lookup_total', kind='user', result=result)
+        return self._check_fresh('user', user)
 
-class Room(object):
-    def __init__(self):
-        pass
+    def resolve_user(self, from_jid):
+        """Returns the user for a 1-1 chat JID. Until the full user list has
+        been loaded the user is fetched on its own via users.show, so this
+        doesn't have to wait for the whole list.
+        """
+        from_jid = self.normalize_jid(from_jid)
+        if self._user_index is None:
+            user_id = from_jid.getNode().split('_', 1)[-1]
+            try:
+                data = self._bot.api.users.show({'user_id': user_id}).get('user')
+            except Exception, e:
+                log.warn('Unable to fetch user %s: %s', user_id, e)
+                data = None
+            if data:
+                data['xmpp_jid'] = from_jid.getStripped()
+                user = User.from_data(data)
+                user.fetched_at = time.time()
+                return user
+        return self.get_sending_user(from_jid)
 
-    @classmethod
-    def from_data(cls, data):
-        self = cls()
-        for k, v in data.iteritems():
-            setattr(self, k, v)
-        return self
+    def _fetch_unknown_user(self, jid):
+        # New users can be fetched directly, as their id is part of the JID
+        stripped = jid.getStripped()
+        user_id = jid.getNode().split('_', 1)[-1]
+        if not user_id.isdigit() or \
+                time.time() - self._unknown.get(stripped, 0) < self._miss_interval:
+            return None
+        try:
+            user = self.fetch_user(user_id)
+        except Exception, e:
+            log.warn('Unable to fetch user %s: %s', user_id, e)
+            user = None
+        if user is None:
+            self._unknown[stripped] = time.time()
+        else:
+            self._unknown.pop(stripped, None)
+        return user
+
+def _lower(value):
+    return value.lower() if value is not None else None
+
+def _coerce_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
 
+def _freeze(cls, index):
+    """Returns an index's records as a (fields, rows) pair of plain tuples,
+    which marshal can store.
+    """
+    fields = tuple(cls.__slots__)
+    return fields, [tuple(getattr(record, f) for f in fields)
+                    for record in index.records()]
 
-class User(object):
-    def __init__(self):
-        pass
+def _thaw(cls, keys, fields, rows):
+    """Rebuilds an Index from _freeze() output, None if the fields don't
+    match the record type.
+    """
+    if tuple(fields) != tuple(cls.__slots__):
+        return None
+    now = time.time()
+    records = []
+    for row in rows:
+        record = cls(**dict(zip(fields, row)))
+        # Treated as fresh, the sync scheduled after loading revalidates
+        # the whole snapshot at once
+        record.fetched_at = now
+        records.append(record)
+    index = Index(keys)
+    index.extend(records)
+    return index
+
+# Attributes each record type is indexed by, with the normaliser applied to
+# key values. The first one is the primary key.
+USER_KEYS = (
+    ('xmpp_jid', None),
+    ('user_id', _coerce_id),
+    ('name', None),
+    ('mention_name', _lower),
+)
+ROOM_KEYS = (
+    ('xmpp_jid', None),
+    ('room_id', _coerce_id),
+)
+
+class Index(object):
+    """Records keyed by a primary attribute, with secondary maps that are
+    kept in step as records are added.
+    """
+    def __init__(self, keys):
+        self.keys = keys
+        self.primary = keys[0][0]
+        self.maps = dict((attr, {}) for attr, _ in keys)
+
+    def records(self):
+        return self.maps[self.primary].values()
+
+    def extend(self, records):
+        primary = self.maps[self.primary]
+        for record in records:
+            old = primary.get(getattr(record, self.primary))
+            for attr, normalise in self.keys:
+                lookup = self.maps[attr]
+                if old is not None:
+                    key = getattr(old, attr)
+                    if normalise is not None:
+                        key = normalise(key)
+                    if lookup.get(key) is old:
+                        del lookup[key]
+                key = getattr(record, attr)
+                if normalise is not None:
+                    key = normalise(key)
+                if key is not None:
+                    lookup[key] = record
+
+class Record(object):
+    """Compact record built from an API payload, keeping only the fields
+    listed in __slots__ and dropping everything else.
+    """
+    __slots__ = ('fetched_at',)
+
+    def __init__(self, **kwargs):
+        for field in self._fields():
+            setattr(self, field, kwargs.get(field))
+
+    @classmethod
+    def _fields(cls):
+        fields = []
+        for klass in reversed(cls.__mro__):
+            fields.extend(getattr(klass, '__slots__', ()))
+        return fields
 
     @classmethod
     def from_data(cls, data):
-        self = cls()
-        for k, v in data.iteritems():
-            setattr(self, k, v)
-        return self
+        return cls(**dict((str(k), v) for k, v in data.iteritems()))
+
+    def same_as(self, other):
+        """True if both records hold the same data, ignoring fetched_at.
+        """
+        return type(self) is type(other) and all(
+            getattr(self, f) == getattr(other, f) for f in self.__slots__)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, ' '.join(
+            '%s=%r' % (f, getattr(self, f)) for f in self.__slots__))
+
+
+class Room(Record):
+    __slots__ = ('room_id', 'name', 'xmpp_jid')
+
+
+class User(Record):
+    __slots__ = ('user_id', 'name', 'mention_name', 'email', 'xmpp_jid')
 
 """
 Kinds of inbound messages:
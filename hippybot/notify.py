@@ -0,0 +1,185 @@
+import time
+import logging
+import threading
+from collections import deque
+
+import requests
+
+# Attempts made to deliver a notification before it's dropped
+DEFAULT_RETRIES = 5
+# Seconds before the first retry, doubled on each further attempt
+DEFAULT_BACKOFF = 1.0
+# Maximum notifications waiting to be sent, the oldest are dropped beyond it
+DEFAULT_QUEUE_SIZE = 1000
+# HipChat rejects room messages longer than this
+MAX_MESSAGE_LENGTH = 10000
+
+# API error codes worth retrying
+TRANSIENT_ERRORS = (403, 429, 500, 502, 503, 504)
+
+log = logging.getLogger(__name__)
+
+
+class Notification(object):
+    __slots__ = ('room_id', 'sender', 'message', 'color', 'format')
+
+    def __init__(self, room_id, sender, message, color, format):
+        self.room_id = room_id
+        self.sender = sender
+        self.message = message
+        self.color = color
+        self.format = format
+
+    def key(self):
+        return (self.sender, self.color, self.format)
+
+    def apiargs(self):
+        return {
+            'room_id': self.room_id,
+            'from': self.sender,
+            'color': self.color,
+            'message_format': self.format,
+            'message': self.message
+        }
+
+
+class Notifier(object):
+    """Background sender for room notifications (api.rooms.message).
+
+    notify() only queues the notification. A dedicated thread delivers the
+    queue room by room using the bot's pooled API client. Identical
+    notifications queued for a room are dropped, and consecutive ones with
+    the same sender, colour and format are merged into a single API call.
+    Transient failures are retried with exponential backoff.
+    """
+    def __init__(self, api, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF,
+                 queue_size=DEFAULT_QUEUE_SIZE):
+        self._api = api
+        self.retries = retries
+        self.backoff = backoff
+        self.queue_size = queue_size
+        self._cond = threading.Condition()
+        self._pending = {}
+        self._rooms = deque()
+        self._depth = 0
+        self._busy = False
+        self._closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        self._thread = threading.Thread(target=self._run,
+                                        name='hippybot-notifier')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def depth(self):
+        """Number of notifications waiting to be sent.
+        """
+        return self._depth
+
+    def notify(self, room_id, message, sender, color='purple', format='html'):
+        """Queue a notification, returns immediately.
+        """
+        notification = Notification(room_id, sender, message, color, format)
+        with self._cond:
+            pending = self._pending.get(room_id)
+            if pending is None:
+                pending = self._pending[room_id] = []
+                self._rooms.append(room_id)
+            for queued in pending:
+                if queued.key() == notification.key() and \
+                        queued.message == message:
+                    self.dropped += 1
+                    return
+            pending.append(notification)
+            self._depth += 1
+            if self._depth > self.queue_size:
+                self._drop_oldest()
+            self._cond.notify()
+
+    def _drop_oldest(self):
+        room_id = self._rooms[0]
+        pending = self._pending[room_id]
+        dropped = pending.pop(0)
+        if not pending:
+            del self._pending[room_id]
+            self._rooms.popleft()
+        self._depth -= 1
+        self.dropped += 1
+        log.warn('Notification queue full (%d), dropped message for room %s',
+                 self.queue_size, dropped.room_id)
+
+    def _merge(self, pending):
+        """Collapse consecutive notifications with the same sender, colour
+        and format into one, within HipChat's message length limit.
+        """
+        merged = []
+        for notification in pending:
+            last = merged[-1] if merged else None
+            separator = u'<br/>' if notification.format == 'html' else u'\n'
+            if last is not None and last.key() == notification.key() and \
+                    len(last.message) + len(separator) + \
+                    len(notification.message) <= MAX_MESSAGE_LENGTH:
+                last.message = u'%s%s%s' % (last.message, separator,
+                                            notification.message)
+            else:
+                merged.append(notification)
+        return merged
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._rooms and not self._closed:
+                    self._cond.wait()
+                if not self._rooms:
+                    return
+                room_id = self._rooms.popleft()
+                pending = self._pending.pop(room_id)
+                self._depth -= len(pending)
+                self._busy = True
+            try:
+                for notification in self._merge(pending):
+                    self._deliver(notification)
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def _deliver(self, notification):
+        delay = self.backoff
+        for attempt in range(1, self.retries + 1):
+            try:
+                result = self._api.rooms.message(notification.apiargs())
+                error = result.get('error') if result else None
+                if not error:
+                    self.sent += 1
+                    return
+                code = error.get('code')
+                if code not in TRANSIENT_ERRORS:
+                    log.error('HipChat rejected notification for room %s: %s',
+                              notification.room_id, error.get('message'))
+                    self.failed += 1
+                    return
+                reason = '%s %s' % (code, error.get('message', ''))
+            except (requests.RequestException, ValueError), e:
+                reason = e
+            if attempt < self.retries:
+                log.warn('Notification for room %s failed (%s), retrying in '
+                         '%.1fs', notification.room_id, reason, delay)
+                time.sleep(delay)
+                delay *= 2
+        log.error('Giving up on notification for room %s after %d attempts',
+                  notification.room_id, self.retries)
+        self.failed += 1
+
+    def close(self, timeout=10):
+        """Send what's queued, waiting up to timeout seconds, and stop the
+        sender thread.
+        """
+        deadline = time.time() + timeout
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            while (self._rooms or self._busy) and time.time() < deadline:
+                self._cond.wait(max(0, deadline - time.time()))
+        self._thread.join(max(0, deadline - time.time()))
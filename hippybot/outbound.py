@@ -0,0 +1,127 @@
+import time
+import threading
+from collections import deque
+
+from hippybot.ratelimit import TokenBucket
+
+# Seconds a reply may be held back waiting for others to the same room to
+# merge with
+DEFAULT_COALESCE_WINDOW = 0.1
+# Replies are only merged while the combined body stays under this length
+DEFAULT_COALESCE_MAX = 1000
+
+
+class _Item(object):
+    __slots__ = ('stanza', 'queued_at')
+
+    def __init__(self, stanza, queued_at):
+        self.stanza = stanza
+        self.queued_at = queued_at
+
+
+def _mergeable(stanza):
+    # Only plain text messages are merged, XHTML bodies are left alone
+    return hasattr(stanza, 'getBody') and stanza.getTag('html') is None \
+        and stanza.getBody() is not None
+
+
+class OutboundQueue(object):
+    """Queue of outgoing stanzas, drained by the bot's serve loop.
+
+    Each destination (room or user JID) gets its own FIFO and destinations
+    are served round-robin, so one chatty room can't starve the others.
+    Short plain text replies to the same destination queued within
+    coalesce_window seconds of each other are merged into one stanza, and
+    an optional global rate (stanzas per second) is enforced.
+    """
+    def __init__(self, rate=None, burst=None,
+                 coalesce_window=DEFAULT_COALESCE_WINDOW,
+                 coalesce_max=DEFAULT_COALESCE_MAX, clock=time.time):
+        self._clock = clock
+        self._bucket = TokenBucket(rate, burst or rate, clock=clock) \
+            if rate else None
+        self.coalesce_window = coalesce_window
+        self.coalesce_max = coalesce_max
+        self._lock = threading.Lock()
+        self._queues = {}
+        self._active = deque()
+        self.sent = 0
+        self.merged = 0
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(q) for q in self._queues.itervalues())
+
+    def put(self, stanza):
+        key = None
+        if hasattr(stanza, 'getTo') and stanza.getTo() is not None:
+            key = unicode(stanza.getTo().getStripped())
+        with self._lock:
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = deque()
+                self._active.append(key)
+            queue.append(_Item(stanza, self._clock()))
+
+    def _take(self, queue):
+        """Pops the head of a queue, merged with any mergeable followers.
+        """
+        head = queue.popleft().stanza
+        if not queue or not _mergeable(head):
+            return head
+        bodies = [head.getBody()]
+        size = len(bodies[0])
+        while queue:
+            stanza = queue[0].stanza
+            if not _mergeable(stanza) or \
+                    stanza.getType() != head.getType() or \
+                    stanza.getThread() != head.getThread() or \
+                    size + len(stanza.getBody()) + 1 > self.coalesce_max:
+                break
+            queue.popleft()
+            bodies.append(stanza.getBody())
+            size += len(bodies[-1]) + 1
+        if len(bodies) > 1:
+            self.merged += len(bodies) - 1
+            head.setBody(u'\n'.join(bodies))
+        return head
+
+    def _ready(self, queue, now):
+        # Hold a mergeable head back for the coalesce window, unless enough
+        # has already been queued behind it
+        item = queue[0]
+        return len(queue) > 1 or not _mergeable(item.stanza) or \
+            now - item.queued_at >= self.coalesce_window
+
+    def drain(self, send, force=False):
+        """Pass queued stanzas to send(), round-robin across destinations,
+        until the queue is empty, the rate limit is reached or everything
+        left is waiting on its coalesce window. force ignores both of those,
+        e.g. when shutting down. Returns the number of stanzas sent.
+        """
+        count = 0
+        while True:
+            with self._lock:
+                now = self._clock()
+                stanza = None
+                for _ in range(len(self._active)):
+                    key = self._active.popleft()
+                    queue = self._queues[key]
+                    if not force and not self._ready(queue, now):
+                        self._active.append(key)
+                        continue
+                    if not force and self._bucket is not None and \
+                            self._bucket.try_consume():
+                        self._active.appendleft(key)
+                        return count
+                    stanza = self._take(queue)
+                    if queue:
+                        self._active.append(key)
+                    else:
+                        del self._queues[key]
+                    break
+            if stanza is None:
+                return count
+            send(stanza)
+            count += 1
+            self.sent += 1
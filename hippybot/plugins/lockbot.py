@@ -1,40 +1,120 @@
 import os
 import os.path
-import sqlite3dbm
-from threading import RLock
+import re
+import math
+import time
+import logging
+import sqlite3
+from threading import RLock, Timer
 from hippybot.hipchat import HipChatApi
 from hippybot.decorators import directcmd, botcmd
 
-CONFIG_DIR = os.path.expanduser("~/.techbot")
-DB = os.path.expanduser("~/.techbot/techbot.db")
+# Databases used by earlier versions, migrated into bot.storage on first use
+SQLITE_DB = os.path.expanduser("~/.techbot/locks.sqlite")
+LEGACY_DB = os.path.expanduser("~/.techbot/techbot.db")
+
+# Lease durations such as 90s, 30m, 2h or 1d
+DURATION_RE = re.compile(r'^(\d+)([smhd])$')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+log = logging.getLogger(__name__)
+
+def parse_duration(token):
+	"""Returns the number of seconds in a lease duration token, or None if
+	the token isn't one.
+	"""
+	m = DURATION_RE.match(token)
+	if m:
+		return int(m.group(1)) * UNITS[m.group(2)]
+	return None
+
+def format_duration(seconds):
+	seconds = max(0, int(math.ceil(seconds)))
+	for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+		if seconds >= size:
+			return "%d%s" % (seconds // size, unit)
+	return "%ds" % seconds
 
 class Plugin(object):
 	"""Plugin to handle knewton locking semantics
 	"""
 	def __init__(self):
 		self.rlock = RLock()
-		self.db = self.get_db()
+		self.timer = None
+		self.closed = False
+		# Expiry times of leases by lock name, so expiring and rescheduling
+		# don't have to read every lock from the store
+		self.leases = {}
+
+	_bot = None
+	@property
+	def bot(self):
+		return self._bot
 
-	def get_db(self):
-		self.create_dir()
-		db = sqlite3dbm.sshelve.open(DB)
-		return db
+	@bot.setter
+	def bot(self, bot):
+		# Leases can only be expired once there's a bot to load them from
+		# and to announce them through
+		self._bot = bot
+		self.schedule_expiry()
 
-	def create_dir(self):
-		if not os.path.exists(CONFIG_DIR):
-			os.mkdir(CONFIG_DIR)
+	_store = None
+	@property
+	def store(self):
+		"""Locks bucket in the bot's storage, keyed by lock name.
+		"""
+		if self._store is None:
+			store = self.bot.storage.bucket('lockbot')
+			self.migrate(store)
+			self.leases = dict((lock, data['expires_at'])
+				for lock, data in store.items() if data['expires_at'])
+			self._store = store
+		return self._store
+
+	def migrate(self, store):
+		"""Import locks from the databases used by earlier versions, once.
+		"""
+		if store.get('migrated', scope='__meta__'):
+			return
+		rows = []
+		try:
+			if os.path.exists(SQLITE_DB):
+				db = sqlite3.connect(SQLITE_DB)
+				rows = db.execute("SELECT name, owner, room, note, created_at, "
+					"expires_at FROM locks").fetchall()
+				db.close()
+			elif os.path.exists(LEGACY_DB):
+				import sqlite3dbm
+				legacy = sqlite3dbm.sshelve.open(LEGACY_DB)
+				rows = [(lock, owner, room, note, time.time(), None)
+					for lock, owner, note, room in legacy.get('lock', {}).values()]
+		except Exception, e:
+			log.exception("Unable to migrate locks: %s", e)
+			return
+		for lock, owner, room, note, created_at, expires_at in rows:
+			store.set(lock, {'owner': owner, 'room': room, 'note': note,
+				'created_at': created_at, 'expires_at': expires_at})
+		if rows:
+			log.info("Migrated %d locks", len(rows))
+		store.set('migrated', True, scope='__meta__')
 
 	@botcmd
 	def lock(self, mess, args, **kwargs):
 		"""
-		Establish a lock over a resource.
+		Establish a lock over a resource, optionally as a lease that expires
+		after a duration such as 90s, 30m, 2h or 1d.
 		Only you can unlock, but anyone can break.
-		Format: @NickName lock <lockname> (message)
+		Format: @NickName lock <lockname> (duration) (message)
 		"""
 		self.bot.log.info("lock: %s" % mess)
 		room, owner, lock, note = self.get_lock_fundamentals(mess)
+		lease = None
+		if note:
+			lease = parse_duration(note.split(" ")[0])
+			if lease is not None:
+				note = note.split(" ", 1)[1] if " " in note else ""
 		try:
-			response = self.set_lock(lock, owner, room, note)
+			response = self.set_lock(lock, owner, room, note, lease)
 			return response
 		except Exception, e:
 			return str(e)
@@ -89,46 +169,115 @@ class Plugin(object):
 		# For future use
 		pass
 
-	def set_lock(self, lock, owner, room, note):
+	def set_lock(self, lock, owner, room, note, lease=None):
+		now = time.time()
+		expires_at = now + lease if lease else None
 		with self.rlock:
-			locks = self.db.get('lock', {})
-			if locks.get(lock):
-				elock, eowner, enote, eroom = locks.get(lock)
-				if eowner != owner:
+			existing = self.store.get(lock)
+			if existing:
+				if existing['owner'] != owner:
 					raise Exception("Lock already held: \n"
-						"    %s: %s (%s)" % (lock, eowner, enote))
-			locks[lock] = (lock, owner, note, room)
-			self.db['lock'] = locks
+						"    %s: %s (%s)" % (lock, existing['owner'],
+							existing['note']))
+			self.store.set(lock, {'owner': owner, 'room': room, 'note': note,
+				'created_at': now, 'expires_at': expires_at})
+			if lease:
+				self.leases[lock] = expires_at
+			else:
+				self.leases.pop(lock, None)
+			if lease:
+				self.schedule_expiry()
+				return "Lock established: \n    %s: %s %s (expires in %s)" % (
+					lock, owner, note, format_duration(lease))
 			return "Lock established: \n    %s: %s %s" % (
 				lock, owner, note)
 
 	def get_locks(self):
-		locks = self.db.get('lock', {})
+		now = time.time()
 		message = ["Existing Locks:"]
-		for lock, owner, note, _ in locks.values():
-			message.append("    %s: %s %s" %(
-				lock, owner, note))
+		for lock, data in sorted(self.store.items()):
+			if data['expires_at']:
+				message.append("    %s: %s %s (expires in %s)" %(
+					lock, data['owner'], data['note'],
+					format_duration(data['expires_at'] - now)))
+			else:
+				message.append("    %s: %s %s" %(
+					lock, data['owner'], data['note']))
 		if len(message) == 1:
 			message.append("    NONE")
 		return '\n'.join(message)
 
 	def release_lock(self, lock, owner, break_lock=False):
 		with self.rlock:
-			locks = self.db.get('lock', {})
-			if locks.get(lock):
-				elock, eowner, enote, eroom = locks.get(lock)
-				if eowner == owner:
+			existing = self.store.pop(lock)
+			self.leases.pop(lock, None)
+			if existing:
+				if existing['owner'] == owner:
 					break_lock = False
 			else:
 				raise Exception("Lock does not exist: \n"
 					"    %s" % (lock))
-			del locks[lock]
-			self.db['lock'] = locks
+			self.schedule_expiry()
 			if break_lock:
 				return "LOCK BROKEN: \n    %s: %s" % (lock, owner)
 			else:
 				return "Lock released: \n    %s: %s" % (lock, owner)
 
+	def schedule_expiry(self):
+		"""Arm a single timer for the next lease to expire, replacing any
+		timer already set.
+		"""
+		with self.rlock:
+			if self.timer is not None:
+				self.timer.cancel()
+				self.timer = None
+			if self.closed:
+				return
+			# Loads the leases on first use
+			self.store
+			if self.leases:
+				wait = min(self.leases.values()) - time.time()
+				self.timer = Timer(max(0, wait), self.expire_locks)
+				self.timer.daemon = True
+				self.timer.start()
 
+	def expire_locks(self):
+		"""Release leases that have run out and announce it in the room
+		each was taken in.
+		"""
+		try:
+			now = time.time()
+			store = self.store
+			for lock, expires_at in self.leases.items():
+				if expires_at > now:
+					continue
+				with self.rlock:
+					if self.leases.get(lock) != expires_at:
+						continue
+					del self.leases[lock]
+					# Skip leases renewed or released since, e.g. by another
+					# plugin instance in another worker process. pop() is
+					# atomic, so if two instances expire the same lock only
+					# one announces it
+					data = store.get(lock)
+					if not data or data['expires_at'] != expires_at or \
+							store.pop(lock) is None:
+						if data and data['expires_at']:
+							self.leases[lock] = data['expires_at']
+						continue
+				log.info("lock expired: %s (%s)", lock, data['owner'])
+				self.bot.send(data['room'], "Lock expired: \n    %s: %s" % (
+					lock, data['owner']), message_type='groupchat')
+		except Exception, e:
+			log.exception("Unable to expire locks: %s", e)
+		finally:
+			self.schedule_expiry()
 
-
+	def teardown(self):
+		"""Stop expiring leases, called when the plugin is unloaded.
+		"""
+		with self.rlock:
+			self.closed = True
+			if self.timer is not None:
+				self.timer.cancel()
+				self.timer = None
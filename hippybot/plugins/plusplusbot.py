@@ -1,39 +1,67 @@
 import os
 import os.path
 import re
-import sqlite3dbm
-from threading import RLock
+import logging
+import sqlite3
 from hippybot.hipchat import HipChatApi
-from hippybot.decorators import botcmd, contentcmd
+from hippybot.decorators import botcmd, cached, contentcmd, trigger
 
-CONFIG_DIR = os.path.expanduser("~/.techbot")
-DB = os.path.expanduser("~/.techbot/score.db")
+# Databases used by earlier versions, migrated into bot.storage on first use
+SQLITE_DB = os.path.expanduser("~/.techbot/scores.sqlite")
+LEGACY_DB = os.path.expanduser("~/.techbot/score.db")
+
+log = logging.getLogger(__name__)
 
 class Plugin(object):
 	"""Plugin to handle knewton replacement of ++ bot in partychatapp
 	"""
-	def __init__(self):
-		self.rlock = RLock()
-		self.db = self.get_db()
-
-	def get_db(self):
-		self.create_dir()
-		db = sqlite3dbm.sshelve.open(DB)
-		return db
+	_store = None
+	@property
+	def store(self):
+		"""Scores bucket in the bot's storage, scoped by room and keyed by
+		target.
+		"""
+		if self._store is None:
+			store = self.bot.storage.bucket('plusplusbot')
+			self.migrate(store)
+			self._store = store
+		return self._store
 
-	def create_dir(self):
-		if not os.path.exists(CONFIG_DIR):
-			os.mkdir(CONFIG_DIR)
+	def migrate(self, store):
+		"""Import scores from the databases used by earlier versions, once.
+		"""
+		if store.get('migrated', scope='__meta__'):
+			return
+		rows = []
+		try:
+			if os.path.exists(SQLITE_DB):
+				db = sqlite3.connect(SQLITE_DB)
+				rows = db.execute("SELECT room, target, score FROM scores").fetchall()
+				db.close()
+			elif os.path.exists(LEGACY_DB):
+				import sqlite3dbm
+				legacy = sqlite3dbm.sshelve.open(LEGACY_DB)
+				for room in legacy.keys():
+					for target, score in legacy[room].items():
+						rows.append((room, target, score))
+		except Exception, e:
+			log.exception("Unable to migrate scores: %s", e)
+			return
+		for room, target, score in rows:
+			store.set(target, score, scope=room)
+		if rows:
+			log.info("Migrated %d scores", len(rows))
+		store.set('migrated', True, scope='__meta__')
 
 	@contentcmd
+	@trigger(contains=['++', '--'])
 	def change_score(self, mess, **kwargs):
 		message = mess.getBody()
 		if message:
 			room = str(mess.getFrom()).split("/")[0]
 			user = str(mess.getFrom()).split("/")[1]
 			results = []
-			if message.find('++') > -1 or message.find('--') > -1:
-				self.bot.log.info("plusplusbot: %s" % mess)
+			self.bot.log.info("plusplusbot: %s" % mess)
 			if message.endswith("++") or message.endswith("--"):
 				results.extend(self.process_message(message, room, user))
 			for m in re.findall("\((.*?)\)", message):
@@ -50,15 +78,12 @@ class Plugin(object):
 		if message.endswith('--'):
 			excl = "ouch!"
 			plus = -1
-		with self.rlock:
-			scores = self.db.get(room, {})
-			score = scores.setdefault(victim, 0)
-			score += plus
-			scores[victim] = score
-			self.db[room] = scores
-			return ["[%s] %s [%s now at %s]" % (user, victim, excl, score)]
+		score = self.store.incr(victim, plus, scope=room)
+		self.scores.invalidate()
+		return ["[%s] %s [%s now at %s]" % (user, victim, excl, score)]
 
 	@botcmd
+	@cached(ttl=60, room=True)
 	def scores(self, mess, args, **kwargs):
 		"""
 		Prints all scores from this room
@@ -67,9 +92,9 @@ class Plugin(object):
 		self.bot.log.info("score: %s" % mess)
 		room = str(mess.getFrom()).split("/")[0]
 		ret = []
-		with self.rlock:
-			scores = self.db.get(room, {})
-			for key in scores:
-				ret.append("%s: %s" %(key, scores[key]))
+		rows = sorted(self.store.items(scope=room),
+			key=lambda item: (-item[1], item[0]))
+		for key, score in rows:
+			ret.append("%s: %s" %(key, score))
 		return '\n'.join(ret)
 
@@ -1,6 +1,7 @@
-import re
 import requests
-from BeautifulSoup import BeautifulSoup as Soup
+from HTMLParser import HTMLParser
+from htmlentitydefs import name2codepoint
+from hippybot.cache import LRUCache, SingleFlight
 from hippybot.hipchat import HipChatApi
 from hippybot.decorators import directcmd
 try:
@@ -10,11 +11,62 @@ except ImportError:
 
 UD_SEARCH_URI = "http://www.urbandictionary.com/iphone/search/define"
 
+# Number of terms to keep definitions for, and for how long (in seconds).
+# Terms without definitions are remembered for a shorter time.
+CACHE_SIZE = 512
+CACHE_TTL = 3600
+NEGATIVE_CACHE_TTL = 300
+# Seconds to wait for Urban Dictionary to connect and to respond
+TIMEOUT = (5, 10)
+
+
+class TextExtractor(HTMLParser):
+    """Single pass HTML to text converter, drops tags and decodes entities.
+    """
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.parts = []
+
+    def handle_data(self, data):
+        self.parts.append(data)
+
+    def handle_entityref(self, name):
+        codepoint = name2codepoint.get(name)
+        if codepoint is not None:
+            self.parts.append(unichr(codepoint))
+        else:
+            self.parts.append(u'&%s;' % name)
+
+    def handle_charref(self, name):
+        try:
+            if name[:1] in ('x', 'X'):
+                self.parts.append(unichr(int(name[1:], 16)))
+            else:
+                self.parts.append(unichr(int(name)))
+        except (ValueError, OverflowError):
+            self.parts.append(u'&#%s;' % name)
+
+
+def strip_html(text):
+    """Returns text with HTML tags removed and entities decoded.
+    """
+    if u'<' not in text and u'&' not in text:
+        return text
+    extractor = TextExtractor()
+    extractor.feed(text)
+    extractor.close()
+    return u''.join(extractor.parts)
+
+
 class Plugin(object):
     """Plugin to lookup definitions from urbandictionary.com
     """
     global_commands = ('udefine',)
 
+    def __init__(self):
+        self.cache = LRUCache(maxsize=CACHE_SIZE, ttl=CACHE_TTL)
+        self.inflight = SingleFlight()
+
     @directcmd
     def udefine(self, mess, args):
         """
@@ -23,7 +75,27 @@ class Plugin(object):
         """
         self.bot.log.info("udefine: %s" % mess)
         term = args.strip()
-        req = requests.get(UD_SEARCH_URI, params={'term': term})
+        results = self.cache.get(term)
+        if results is None:
+            # Identical lookups already in progress (e.g. the same term
+            # spammed in several rooms) share one request
+            try:
+                results = self.inflight.do(term, self.lookup, term)
+            except requests.RequestException, e:
+                self.bot.log.warn("udefine: lookup of %s failed: %s" % (
+                    term, e))
+                return u'Unable to reach Urban Dictionary, try again later'
+        if results:
+            reply = u"\n".join(results)
+            return reply
+        else:
+            return u'No matches found for "%s"' % (term,)
+
+    def lookup(self, term):
+        """Fetch and sanitize the definitions of term, caching the result.
+        """
+        req = requests.get(UD_SEARCH_URI, params={'term': term},
+                           timeout=TIMEOUT)
         data = req.content
         results = []
         if data:
@@ -33,14 +105,7 @@ class Plugin(object):
                 for datum in data['list']:
                     if datum.get('word', '') == term:
                         # Sanitization
-                        definition = datum['definition']
-                        re.sub(r'\s', ' ', definition)
-                        definition = u''.join(Soup(definition).findAll(text=True))
-                        definition = unicode(Soup(definition, convertEntities=Soup.HTML_ENTITIES))
-                        results.append(definition)
-        if results:
-            reply = u"\n".join(results)
-            return reply
-        else:
-            return u'No matches found for "%s"' % (term,)
-
+                        results.append(strip_html(datum['definition']))
+        self.cache.set(term, results,
+                       ttl=CACHE_TTL if results else NEGATIVE_CACHE_TTL)
+        return results
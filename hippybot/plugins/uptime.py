@@ -1,8 +1,9 @@
 import subprocess
-from hippybot.decorators import botcmd
+from hippybot.decorators import botcmd, cached
 
 class Plugin(object):
 	@botcmd
+	@cached(ttl=10)
 	def uptime(self, mess, args, **kwargs):
 		"""Get current uptime information"""
 		self.bot.log.info("uptime: %s" % mess)
@@ -0,0 +1,173 @@
+import os
+import os.path
+import sys
+import time
+import logging
+import threading
+from collections import defaultdict
+
+DEFAULT_INTERVAL = 0.005
+DEFAULT_DURATION = 30
+# Longest a profile may be asked to run for, in seconds
+DEFAULT_MAX_DURATION = 300
+DEFAULT_OUTPUT_DIR = os.path.expanduser('~/.hippybot/profiles')
+DEFAULT_TOP = 20
+
+# Leaf frames of threads that are blocked waiting for work rather than
+# running, e.g. idle workers. Their samples are left out of the summary.
+IDLE_FRAMES = (
+    ('threading.py', 'wait'),
+    ('Queue.py', 'get'),
+    ('SocketServer.py', 'serve_forever'),
+    ('transports.py', 'pending_data'),
+    ('transports.py', 'receive'),
+)
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+log = logging.getLogger(__name__)
+
+
+def _short_path(filename, _cache={}):
+    path = _cache.get(filename)
+    if path is None:
+        path = filename
+        for entry in sorted(sys.path, key=len, reverse=True):
+            if entry and filename.startswith(entry + os.sep):
+                path = filename[len(entry) + 1:]
+                break
+        _cache[filename] = path
+    return path
+
+
+def _label(code):
+    return '%s (%s:%d)' % (code.co_name, _short_path(code.co_filename),
+                           code.co_firstlineno)
+
+
+class SamplingProfiler(object):
+    """Statistical profiler for the running process.
+
+    A background thread records the stack of every other thread each
+    interval seconds, using sys._current_frames(), so nothing needs to be
+    instrumented and the profiled code runs at full speed between samples.
+    When done it writes the samples in the collapsed stack format used by
+    flamegraph.pl and speedscope, and a summary of the hottest functions.
+    """
+    def __init__(self, duration=DEFAULT_DURATION, interval=DEFAULT_INTERVAL,
+                 output_dir=DEFAULT_OUTPUT_DIR, top=DEFAULT_TOP,
+                 callback=None):
+        self.duration = duration
+        self.interval = interval
+        self.output_dir = output_dir
+        self.top = top
+        self.callback = callback
+        self.samples = 0
+        self.elapsed = 0
+        self.stacks = defaultdict(int)
+        self.paths = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='hippybot-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling early, the results are still written.
+        """
+        self._stop.set()
+
+    def _run(self):
+        started = time.time()
+        deadline = started + self.duration
+        own = threading.current_thread().ident
+        names = {}
+        while not self._stop.is_set() and time.time() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code)
+                    frame = frame.f_back
+                name = names.get(ident)
+                if name is None:
+                    for thread in threading.enumerate():
+                        names[thread.ident] = thread.name.replace(';', '_')
+                    name = names.get(ident, str(ident))
+                self.stacks[(name,) + tuple(reversed(stack))] += 1
+            self.samples += 1
+            self._stop.wait(self.interval)
+        self.elapsed = time.time() - started
+        try:
+            self.paths = self.write()
+        except (IOError, OSError), e:
+            log.error('Unable to write profile to %s: %s', self.output_dir, e)
+        if self.callback is not None:
+            self.callback(self)
+
+    def collapsed(self):
+        """Yields 'thread;frame;frame... count' lines, outermost frame
+        first.
+        """
+        for stack, count in sorted(self.stacks.iteritems()):
+            yield '%s %d' % (';'.join([stack[0]] + [_label(code) for code
+                                                    in stack[1:]]), count)
+
+    def _busy(self):
+        for stack, count in self.stacks.iteritems():
+            leaf = stack[-1]
+            if (os.path.basename(leaf.co_filename), leaf.co_name) \
+                    not in IDLE_FRAMES:
+                yield stack, count
+
+    def summary(self):
+        """Returns the top functions by samples spent in the function
+        itself, and the top functions of HippyBot and its plugins by
+        samples spent in or below them, as lines of text.
+        """
+        own = defaultdict(int)
+        inclusive = defaultdict(int)
+        busy = 0
+        for stack, count in self._busy():
+            busy += count
+            own[stack[-1]] += count
+            for code in set(stack[1:]):
+                if code.co_filename.startswith(PACKAGE_DIR):
+                    inclusive[code] += count
+        lines = ['%d samples of %d threads over %.1fs, %d while busy' % (
+            self.samples, len(set(s[0] for s in self.stacks)),
+            self.elapsed, busy)]
+        for title, counts in (('Hottest functions (own time):', own),
+                              ('Hottest HippyBot and plugin functions '
+                               '(including callees):', inclusive)):
+            lines.extend(['', title])
+            hottest = sorted(counts.iteritems(), key=lambda i: -i[1])
+            for code, count in hottest[:self.top]:
+                lines.append('%5.1f%% %6d  %s' % (
+                    100.0 * count / max(busy, 1), count, _label(code)))
+        return lines
+
+    def write(self):
+        """Write the collapsed stacks and summary to output_dir, returns
+        their paths.
+        """
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        base = os.path.join(self.output_dir, 'profile-%s-%d' % (
+            time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+        paths = (base + '.collapsed', base + '.txt')
+        with open(paths[0], 'w') as f:
+            for line in self.collapsed():
+                f.write(line + '\n')
+        with open(paths[1], 'w') as f:
+            f.write('\n'.join(self.summary()) + '\n')
+        log.info('Profile written to %s and %s', *paths)
+        return paths
@@ -0,0 +1,73 @@
+import time
+import threading
+
+
+class TokenBucket(object):
+    """Thread safe token bucket.
+
+    Holds up to ``capacity`` tokens, refilled at ``rate`` tokens per second.
+    """
+    def __init__(self, rate, capacity=None, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._stamp = clock()
+        self._blocked_until = 0
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._stamp
+        if elapsed > 0:
+            self._tokens = min(self.capacity,
+                               self._tokens + elapsed * self.rate)
+            self._stamp = now
+
+    def try_consume(self, tokens=1):
+        """Takes tokens if available, returns 0 on success or the number of
+        seconds to wait before they would be.
+        """
+        with self._lock:
+            now = self._clock()
+            if now < self._blocked_until:
+                return self._blocked_until - now
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            if self.rate <= 0:
+                return float('inf')
+            return (tokens - self._tokens) / self.rate
+
+    def consume(self, tokens=1, timeout=None):
+        """Blocks until tokens are available, returns False if that would
+        take longer than timeout seconds.
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        while True:
+            wait = self.try_consume(tokens)
+            if not wait:
+                return True
+            if deadline is not None and self._clock() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def update(self, remaining=None, reset=None):
+        """Sync the bucket with a server reported quota, e.g. from
+        rate-limit response headers. ``reset`` is the epoch time at which
+        the server quota refills.
+        """
+        with self._lock:
+            now = self._clock()
+            self._refill(now)
+            if remaining is not None:
+                self._tokens = min(self._tokens, float(remaining))
+                if remaining <= 0 and reset is not None:
+                    self._blocked_until = max(self._blocked_until,
+                                              float(reset))
+
+    @property
+    def tokens(self):
+        with self._lock:
+            self._refill(self._clock())
+            return self._tokens
@@ -0,0 +1,118 @@
+import os.path
+import logging
+from collections import OrderedDict
+
+from hippybot.routing import RoutingTable
+
+log = logging.getLogger(__name__)
+
+
+def source_mtime(module):
+    """Returns the modification time of a module's source file, or None if
+    it can't be determined.
+    """
+    path = getattr(module, '__file__', None)
+    if not path:
+        return None
+    if path.endswith(('.pyc', '.pyo')) and os.path.exists(path[:-1]):
+        path = path[:-1]
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+class PluginRegistration(object):
+    """Everything a single plugin module registered with the bot.
+    """
+    def __init__(self, name, module, plugin=None):
+        self.name = name
+        self.module = module
+        self.plugin = plugin
+        self.mtime = source_mtime(module)
+        self.commands = []
+        self.content_commands = []
+        self.global_commands = ()
+        self.command_aliases = {}
+        self.all_msg_handlers = ()
+        # IsolatedPlugin running the plugin, if it runs in worker processes
+        self.isolated = None
+
+    def close(self):
+        """Called when the plugin is unloaded, e.g. replaced by a reload.
+        Stops its worker processes, if it has any, and calls the plugin's
+        teardown() method if it defines one.
+        """
+        if self.isolated is not None:
+            self.isolated.close()
+        teardown = getattr(self.plugin, 'teardown', None)
+        if teardown is not None:
+            try:
+                teardown()
+            except Exception, e:
+                log.exception('Error tearing down plugin %s: %s', self.name, e)
+
+    def changed(self):
+        """True if the module's source has been modified since it was
+        loaded.
+        """
+        mtime = source_mtime(self.module)
+        return mtime is None or mtime != self.mtime
+
+    def command_names(self):
+        return [name for name, _ in self.commands + self.content_commands]
+
+
+class Registry(object):
+    """Snapshot of the commands and handlers of every loaded plugin.
+
+    A registry is never modified once built. Reloading plugins builds a new
+    one which the bot swaps in with a single assignment, so a message being
+    processed sees either the old or the new set of registrations, never a
+    mix of both. Global commands and all message handlers are deduplicated.
+
+    plugin_triggers maps plugin names to a Trigger applying to all of their
+    handlers, e.g. the rooms they're enabled in.
+    """
+    def __init__(self, base_commands=None, registrations=(),
+                 plugin_triggers=None):
+        self.registrations = OrderedDict((r.name, r) for r in registrations)
+        self.commands = dict(base_commands or {})
+        self.content_commands = OrderedDict()
+        self.command_aliases = {}
+        global_commands = []
+        all_msg_handlers = []
+        handler_triggers = {}
+        for registration in self.registrations.itervalues():
+            trigger = (plugin_triggers or {}).get(registration.name)
+            if trigger is not None:
+                for _, func in registration.commands + \
+                        registration.content_commands:
+                    handler_triggers[func] = trigger
+                for func in registration.all_msg_handlers:
+                    handler_triggers[func] = trigger
+            self.commands.update(registration.commands)
+            self.content_commands.update(registration.content_commands)
+            self.command_aliases.update(registration.command_aliases)
+            for cmd in registration.global_commands:
+                if cmd not in global_commands:
+                    global_commands.append(cmd)
+            for handler in registration.all_msg_handlers:
+                if handler not in all_msg_handlers:
+                    all_msg_handlers.append(handler)
+        self.global_commands = frozenset(global_commands)
+        self.all_msg_handlers = tuple(all_msg_handlers)
+        # Handlers that can care about messages, by room and message type,
+        # each route has a compiled index of the content commands' patterns
+        # so only handlers whose pattern hits get called
+        self.routes = RoutingTable(self.commands.items(),
+                                   self.content_commands.items(),
+                                   self.all_msg_handlers, handler_triggers)
+
+    def plugin_commands(self):
+        """Names of all commands and content commands provided by plugins.
+        """
+        names = set()
+        for registration in self.registrations.itervalues():
+            names.update(registration.command_names())
+        return names
@@ -0,0 +1,172 @@
+import re
+import threading
+
+from hippybot.dispatch import ContentDispatcher
+
+_SEPARATORS_RE = re.compile(r'[,\n]+')
+
+
+def channel_name(name):
+    """Normalises a room name the way the channels option of the
+    [connection] section is, e.g. "Dev Ops" is "dev_ops".
+    """
+    return name.strip().lower().replace(' ', '_')
+
+
+def room_name(jid):
+    """Returns the channel name of a room JID, e.g. "dev_ops" for
+    1234_dev_ops@conf.hipchat.com.
+    """
+    node = unicode(jid).split('@', 1)[0]
+    return node.split('_', 1)[-1]
+
+
+def parse_rooms(value):
+    """Parses a list of room names from the config file, separated by
+    commas or new lines.
+    """
+    if not value:
+        return ()
+    return [channel_name(name) for name in _SEPARATORS_RE.split(value)
+            if name.strip()]
+
+
+class Trigger(object):
+    """Conditions a message must meet for a handler to see it.
+
+    rooms only lets messages from those rooms through, exclude_rooms
+    blocks messages from them (rooms are named as in the channels option).
+    Room conditions don't apply to one to one chats. types lists the
+    message types ('groupchat', 'chat') let through, and contains literal
+    substrings at least one of which the body must include. None means no
+    condition.
+    """
+    __slots__ = ('rooms', 'exclude_rooms', 'types', 'contains')
+
+    def __init__(self, rooms=None, exclude_rooms=None, types=None,
+                 contains=None):
+        self.rooms = frozenset(channel_name(room) for room in rooms) \
+            if rooms else None
+        self.exclude_rooms = frozenset(channel_name(room) for room in
+                                       exclude_rooms) \
+            if exclude_rooms else None
+        self.types = frozenset(types) if types else None
+        if isinstance(contains, basestring):
+            contains = (contains,)
+        self.contains = tuple(contains) if contains else None
+
+    def accepts(self, room, type):
+        """True if messages of type from room (None for chats) may be
+        routed to the handler.
+        """
+        if self.types is not None and type not in self.types:
+            return False
+        if room is not None:
+            if self.rooms is not None and room not in self.rooms:
+                return False
+            if self.exclude_rooms is not None and room in self.exclude_rooms:
+                return False
+        return True
+
+    def matches(self, body):
+        """True if body contains one of the trigger's substrings.
+        """
+        if self.contains is None:
+            return True
+        for literal in self.contains:
+            if literal in body:
+                return True
+        return False
+
+
+def handler_trigger(func):
+    """Returns the Trigger declared for a handler with @trigger, if any.
+    """
+    return getattr(func, '_hippybot_trigger', None)
+
+
+class Route(object):
+    """The handlers that can care about messages of one type in one room.
+    """
+    __slots__ = ('all_msg_handlers', 'content_dispatcher', 'blocked_commands')
+
+    def __init__(self, all_msg_handlers, content_dispatcher,
+                 blocked_commands):
+        self.all_msg_handlers = all_msg_handlers
+        self.content_dispatcher = content_dispatcher
+        self.blocked_commands = blocked_commands
+
+
+class RoutingTable(object):
+    """Routes of a registry, by room and message type.
+
+    Each handler's triggers (the plugin wide one from the config file and
+    any declared with @trigger) are checked once per room and message type,
+    the first time a message of that type arrives from the room, rather
+    than for every message. Routes for rooms none of the triggers name are
+    shared. Substring conditions are left to the dispatch of each message.
+    """
+    def __init__(self, commands, content_commands, all_msg_handlers,
+                 plugin_triggers=None):
+        self._commands = commands
+        self._content_commands = content_commands
+        self._all_msg_handlers = all_msg_handlers
+        # Handler to the Trigger set for its plugin in the config file
+        self._plugin_triggers = plugin_triggers or {}
+        self._lock = threading.Lock()
+        self._routes = {}
+        self._rooms = set()
+        for func in self._handlers():
+            for trigger in self.triggers(func):
+                self._rooms.update(trigger.rooms or ())
+                self._rooms.update(trigger.exclude_rooms or ())
+
+    def _handlers(self):
+        for _, func in self._commands:
+            yield func
+        for _, func in self._content_commands:
+            yield func
+        for func in self._all_msg_handlers:
+            yield func
+
+    def triggers(self, func):
+        """Returns the triggers applying to a handler.
+        """
+        triggers = []
+        plugin = self._plugin_triggers.get(func)
+        if plugin is not None:
+            triggers.append(plugin)
+        trigger = handler_trigger(func)
+        if trigger is not None:
+            triggers.append(trigger)
+        return triggers
+
+    def route(self, room, type):
+        """Returns the Route for messages of type from room, which is None
+        for one to one chats.
+        """
+        # All rooms that aren't named by a trigger are routed alike
+        key = (room if room is None or room in self._rooms else '', type)
+        route = self._routes.get(key)
+        if route is None:
+            with self._lock:
+                route = self._routes.get(key)
+                if route is None:
+                    route = self._routes[key] = self._compile(room, type)
+        return route
+
+    def _compile(self, room, type):
+        accepts = lambda func: all(trigger.accepts(room, type)
+                                   for trigger in self.triggers(func))
+        blocked = frozenset(name for name, func in self._commands
+                            if not accepts(func))
+        content_commands = [(name, func) for name, func
+                            in self._content_commands if accepts(func)]
+        all_msg_handlers = []
+        for func in self._all_msg_handlers:
+            if accepts(func):
+                all_msg_handlers.append((getattr(func, '__name__',
+                                                 'handler'),
+                                         func, handler_trigger(func)))
+        return Route(tuple(all_msg_handlers),
+                     ContentDispatcher(content_commands), blocked)
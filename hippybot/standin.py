@@ -0,0 +1,384 @@
+"""Local stand-in for the HipChat v1 REST API.
+
+Serves the ``rooms`` and ``users`` methods HipChatApi knows about (see
+GETS and POSTS in hippybot.hipchat) from a synthetic org, with optional
+latency, error and rate limit injection, so Lookup refreshes and
+notification throughput can be load tested offline. Point the bot at it
+with ``api_base_url`` in the [hipchat] section of the config, e.g.:
+
+    hippybot-standin --users 50000 --rooms 500 --latency 0.05 --port 8011
+
+    [hipchat]
+    api_auth_token = anything
+    api_base_url = http://127.0.0.1:8011
+"""
+import sys
+import time
+import random
+import logging
+import threading
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from optparse import OptionParser
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from hippybot.hipchat import GETS, POSTS
+from hippybot.lookup import ROOM_DOMAIN
+from hippybot.ratelimit import TokenBucket
+
+DEFAULT_PORT = 8011
+DEFAULT_PREFIX = '1'
+
+FIRST_NAMES = (u'Alex', u'Sam', u'Jo', u'Chris', u'Pat', u'Robin', u'Kim',
+               u'Lee', u'Max', u'Charlie', u'Jamie', u'Taylor', u'Morgan')
+LAST_NAMES = (u'Smith', u'Jones', u'Taylor', u'Brown', u'Garcia', u'Chen',
+              u'Nguyen', u'Patel', u'Kowalski', u'Murphy', u'Rossi')
+
+log = logging.getLogger(__name__)
+
+
+class ApiError(Exception):
+    def __init__(self, code, type, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.type = type
+        self.message = message
+
+    def payload(self):
+        return {'error': {'code': self.code, 'type': self.type,
+                          'message': self.message}}
+
+
+class Org(object):
+    """Synthetic HipChat org, users and rooms are numbered from 1 and the
+    first user is meant to be the bot.
+    """
+    def __init__(self, users=1000, rooms=50, prefix=DEFAULT_PREFIX, seed=0):
+        self.prefix = prefix
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.users = {}
+        self.rooms = {}
+        self.messages = 0
+        for user_id in range(1, users + 1):
+            self.add_user(self._user(user_id))
+        for room_id in range(1, rooms + 1):
+            self.add_room(self._room(room_id, u'Room %d' % room_id))
+
+    def _user(self, user_id):
+        first = self._random.choice(FIRST_NAMES)
+        last = u'%s%d' % (self._random.choice(LAST_NAMES), user_id)
+        now = int(time.time())
+        return {
+            'user_id': user_id,
+            'name': u'%s %s' % (first, last),
+            'mention_name': u'%s%s' % (first, last),
+            'email': u'%s.%s@example.com' % (first.lower(), last.lower()),
+            'title': u'',
+            'photo_url': u'',
+            'last_active': now,
+            'created': now,
+            'status': u'available',
+            'status_message': u'',
+            'is_group_admin': 0,
+            'is_deleted': 0,
+        }
+
+    def _room(self, room_id, name, owner_user_id=1, privacy='public'):
+        now = int(time.time())
+        return {
+            'room_id': room_id,
+            'name': name,
+            'topic': u'',
+            'last_active': now,
+            'created': now,
+            'owner_user_id': owner_user_id,
+            'is_archived': False,
+            'is_private': privacy == 'private',
+            'xmpp_jid': u'%s_%s@%s' % (self.prefix,
+                                       name.lower().replace(' ', '_'),
+                                       ROOM_DOMAIN),
+        }
+
+    def add_user(self, user):
+        with self._lock:
+            self.users[user['user_id']] = user
+        return user
+
+    def add_room(self, room):
+        with self._lock:
+            self.rooms[room['room_id']] = room
+        return room
+
+    def user(self, user_id):
+        user = self.users.get(_int(user_id))
+        if user is None:
+            raise ApiError(404, 'Not Found', 'User not found')
+        return user
+
+    def room(self, room_id):
+        room = self.rooms.get(_int(room_id))
+        if room is None:
+            raise ApiError(404, 'Not Found', 'Room not found')
+        return room
+
+    def next_id(self, items):
+        with self._lock:
+            return max(items) + 1 if items else 1
+
+    # API methods, named <section>_<method> and called with the request
+    # parameters
+
+    def rooms_list(self, params):
+        return {'rooms': self.rooms.values()}
+
+    def rooms_show(self, params):
+        room = dict(self.room(_required(params, 'room_id')))
+        room['participants'] = []
+        return {'room': room}
+
+    def rooms_history(self, params):
+        self.room(_required(params, 'room_id'))
+        return {'messages': []}
+
+    def rooms_create(self, params):
+        name = _required(params, 'name')
+        room = self._room(self.next_id(self.rooms), name,
+                          _int(_required(params, 'owner_user_id')),
+                          params.get('privacy', 'public'))
+        return {'room': self.add_room(room)}
+
+    def rooms_delete(self, params):
+        room = self.room(_required(params, 'room_id'))
+        with self._lock:
+            self.rooms.pop(room['room_id'], None)
+        return {'deleted': True}
+
+    def rooms_message(self, params):
+        self.room(_required(params, 'room_id'))
+        _required(params, 'from')
+        if len(_required(params, 'message')) > 10000:
+            raise ApiError(400, 'Bad Request', 'Message is too long')
+        with self._lock:
+            self.messages += 1
+        return {'status': 'sent'}
+
+    def users_list(self, params):
+        return {'users': self.users.values()}
+
+    def users_show(self, params):
+        return {'user': self.user(_required(params, 'user_id'))}
+
+    def users_create(self, params):
+        user = self._user(self.next_id(self.users))
+        user.update(name=_required(params, 'name'),
+                    email=_required(params, 'email'),
+                    mention_name=params.get('mention_name',
+                                            params['name'].replace(' ', '')))
+        return {'user': self.add_user(user)}
+
+    def users_update(self, params):
+        user = self.user(_required(params, 'user_id'))
+        for field in ('name', 'email', 'mention_name', 'title'):
+            if field in params:
+                user[field] = params[field]
+        return {'user': user}
+
+    def users_delete(self, params):
+        user = self.user(_required(params, 'user_id'))
+        with self._lock:
+            self.users.pop(user['user_id'], None)
+        return {'deleted': True}
+
+
+def _required(params, name):
+    value = params.get(name)
+    if value is None or value == '':
+        raise ApiError(400, 'Bad Request', 'Missing parameter: %s' % name)
+    return value
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ApiError(400, 'Bad Request', 'Invalid id: %s' % value)
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    """Threaded HTTP server answering HipChat v1 API requests from an Org.
+
+    Every request is delayed by latency seconds plus up to jitter more, and
+    fails with a 503 with probability error_rate. With a rate_limit, each
+    auth token may make that many requests per rate_period seconds, beyond
+    that HipChat's 403 rate limit error is returned. Responses carry the
+    X-RateLimit headers either way.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, org, latency=0, jitter=0, error_rate=0,
+                 rate_limit=None, rate_period=300, seed=None):
+        HTTPServer.__init__(self, address, _Handler)
+        self.org = org
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.rate_period = rate_period
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.requests = {}
+
+    def count(self, name, status):
+        key = '%s %s' % (name, status)
+        with self._lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def delay(self):
+        with self._lock:
+            jitter = self._random.random() * self.jitter
+        return self.latency + jitter
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def throttle(self, token):
+        """Returns (allowed, remaining, reset) for a request made with
+        token.
+        """
+        if not self.rate_limit:
+            return True, None, None
+        with self._lock:
+            bucket = self._buckets.get(token)
+            if bucket is None:
+                bucket = self._buckets[token] = TokenBucket(
+                    float(self.rate_limit) / self.rate_period,
+                    capacity=self.rate_limit)
+        wait = bucket.try_consume()
+        return not wait, int(bucket.tokens), int(time.time() + wait)
+
+    def start(self):
+        """Serve from a background thread, returns the base URL.
+        """
+        thread = threading.Thread(target=self.serve_forever,
+                                  name='hippybot-standin')
+        thread.daemon = True
+        thread.start()
+        return 'http://%s:%d' % self.server_address
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'HippyBotStandIn/1.0'
+
+    def do_GET(self):
+        self._handle(GETS, urlparse.urlsplit(self.path).query)
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        self._handle(POSTS, self.rfile.read(length))
+
+    def _handle(self, methods, query):
+        path = urlparse.urlsplit(self.path).path.strip('/').split('/')
+        params = dict((k, v[-1].decode('utf-8')) for k, v in
+                      urlparse.parse_qs(query).iteritems())
+        if path == ['stats']:
+            return self._respond(200, {'requests': self.server.requests,
+                                       'messages': self.server.org.messages})
+        name = '.'.join(path[1:])
+        headers = {}
+        try:
+            if len(path) != 3 or path[0] != 'v1' or \
+                    path[2] not in methods.get(path[1], ()):
+                raise ApiError(404, 'Not Found', 'Unknown method: %s' %
+                               '/'.join(path))
+            time.sleep(self.server.delay())
+            if not params.get('auth_token'):
+                raise ApiError(401, 'Unauthorized', 'Auth token not found.')
+            allowed, remaining, reset = self.server.throttle(
+                params['auth_token'])
+            if remaining is not None:
+                headers['X-RateLimit-Limit'] = self.server.rate_limit
+                headers['X-RateLimit-Remaining'] = remaining
+                headers['X-RateLimit-Reset'] = reset
+            if not allowed:
+                raise ApiError(403, 'Forbidden',
+                               'You have exceeded the rate limit.')
+            if self.server.should_fail():
+                raise ApiError(503, 'Service Unavailable',
+                               'Injected failure')
+            status, payload = 200, getattr(self.server.org, '%s_%s' % (
+                path[1], path[2]))(params)
+        except ApiError, e:
+            status, payload = e.code, e.payload()
+        self.server.count(name, status)
+        self._respond(status, payload, headers)
+
+    def _respond(self, status, payload, headers=None):
+        body = json.dumps(payload)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def main():
+    parser = OptionParser(usage="usage: %prog [options]")
+    parser.add_option("--host", default='127.0.0.1',
+                      help="Address to listen on [%default]")
+    parser.add_option("-p", "--port", type="int", default=DEFAULT_PORT,
+                      help="Port to listen on [%default]")
+    parser.add_option("--users", type="int", default=1000,
+                      help="Users in the synthetic org [%default]")
+    parser.add_option("--rooms", type="int", default=50,
+                      help="Rooms in the synthetic org [%default]")
+    parser.add_option("--prefix", default=DEFAULT_PREFIX,
+                      help="Org prefix used in XMPP JIDs [%default]")
+    parser.add_option("--latency", type="float", default=0,
+                      help="Seconds added to every request [%default]")
+    parser.add_option("--jitter", type="float", default=0,
+                      help="Up to this many more random seconds [%default]")
+    parser.add_option("--error-rate", type="float", default=0,
+                      help="Fraction of requests failed with a 503 "
+                      "[%default]")
+    parser.add_option("--rate-limit", type="int", default=0,
+                      help="Requests allowed per token per rate period, "
+                      "0 is unlimited [%default]")
+    parser.add_option("--rate-period", type="int", default=300,
+                      help="Rate limit period in seconds [%default]")
+    parser.add_option("--seed", type="int", default=0)
+    options, _ = parser.parse_args()
+
+    logging.basicConfig(level='INFO')
+    org = Org(users=options.users, rooms=options.rooms,
+              prefix=options.prefix, seed=options.seed)
+    server = StandInServer((options.host, options.port), org,
+                           latency=options.latency, jitter=options.jitter,
+                           error_rate=options.error_rate,
+                           rate_limit=options.rate_limit,
+                           rate_period=options.rate_period, seed=options.seed)
+    log.info('Serving %d users and %d rooms on http://%s:%d', options.users,
+             options.rooms, options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
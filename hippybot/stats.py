@@ -0,0 +1,238 @@
+import math
+import time
+import logging
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+
+# Histogram buckets grow by this factor, so reported percentiles are within
+# about 10% of the real value
+BUCKET_BASE = 2 ** 0.25
+# Values are recorded in seconds, anything below this is counted as it
+MIN_VALUE = 1e-6
+PERCENTILES = (0.5, 0.95, 0.99)
+PREFIX = 'hippybot_'
+
+log = logging.getLogger(__name__)
+
+_LOG_BASE = math.log(BUCKET_BASE)
+_MIN_BUCKET = int(math.floor(math.log(MIN_VALUE) / _LOG_BASE))
+
+
+class Histogram(object):
+    """Counts of observed values in logarithmic buckets.
+
+    Recording a value costs one log() and a dict update, and memory only
+    grows with the range of values seen, not their number.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        if value > MIN_VALUE:
+            bucket = int(math.floor(math.log(value) / _LOG_BASE))
+        else:
+            bucket = _MIN_BUCKET
+        with self._lock:
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, q):
+        """Returns the upper bound of the bucket the q-th (0 to 1) value
+        falls in, None if nothing has been recorded.
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = q * self.count
+            seen = 0
+            for bucket in sorted(self._buckets):
+                seen += self._buckets[bucket]
+                if seen >= rank:
+                    return BUCKET_BASE ** (bucket + 1)
+
+    def percentiles(self):
+        return [(q, self.percentile(q)) for q in PERCENTILES]
+
+
+class Stats(object):
+    """Registry of counters, histograms and gauges.
+
+    Metrics are identified by a name and optional labels, e.g.
+    ``observe('command_seconds', 0.2, command='ping')``. Gauges are
+    functions called when the stats are read, so reading queue depths and
+    the like costs nothing until then. Collectors are functions yielding
+    several (name, labels, value) gauges at once.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._collectors = {}
+
+    def incr(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Context manager recording the seconds spent in its block.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - started, **labels)
+
+    def gauge(self, name, func, **labels):
+        """Register a function returning the current value of a gauge, it
+        replaces any previous function registered for the same gauge.
+        """
+        self._gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def collector(self, name, func):
+        """Register a function yielding (name, labels, value) tuples for
+        gauges that aren't known in advance, it replaces any previous
+        collector with the same name.
+        """
+        self._collectors[name] = func
+
+    def counters(self):
+        with self._lock:
+            return sorted(self._counters.items())
+
+    def histograms(self):
+        with self._lock:
+            return sorted(self._histograms.items())
+
+    def gauges(self):
+        values = []
+        for key, func in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception, e:
+                log.warn('Unable to read gauge %s: %s', key[0], e)
+                continue
+            if value is not None:
+                values.append((key, value))
+        for collector, func in sorted(self._collectors.items()):
+            try:
+                for name, labels, value in func():
+                    if value is not None:
+                        values.append(((name, tuple(sorted(labels.items()))),
+                                       value))
+            except Exception, e:
+                log.warn('Unable to read %s stats: %s', collector, e)
+        return values
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def summary(self):
+        """Returns the stats as human readable lines.
+        """
+        lines = []
+        for key, value in self.counters() + self.gauges():
+            lines.append(u'%s: %s' % (_describe(key), value))
+        for key, histogram in self.histograms():
+            lines.append(u'%s: n=%d %s' % (_describe(key), histogram.count,
+                ' '.join('p%d=%s' % (q * 100, _format_seconds(value))
+                         for q, value in histogram.percentiles())))
+        return lines
+
+    def prometheus(self):
+        """Returns the stats in the Prometheus text exposition format.
+        """
+        lines = []
+        typed = set()
+        def metric(name, kind):
+            name = PREFIX + name
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, kind))
+            return name
+        for (name, labels), value in self.counters():
+            lines.append('%s%s %s' % (metric(name, 'counter'),
+                                      _labels(labels), value))
+        for (name, labels), value in self.gauges():
+            lines.append('%s%s %s' % (metric(name, 'gauge'),
+                                      _labels(labels), value))
+        for (name, labels), histogram in self.histograms():
+            name = metric(name, 'summary')
+            for q, value in histogram.percentiles():
+                lines.append('%s%s %s' % (name,
+                    _labels(labels + (('quantile', q),)), value))
+            lines.append('%s_sum%s %s' % (name, _labels(labels),
+                                          histogram.sum))
+            lines.append('%s_count%s %s' % (name, _labels(labels),
+                                            histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _describe(key):
+    name, labels = key
+    if not labels:
+        return name
+    return u'%s{%s}' % (name, u','.join(u'%s=%s' % label for label in labels))
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, unicode(v).replace('\\', '\\\\')
+                             .replace('"', '\\"').replace('\n', '\\n'))
+                             for k, v in labels)
+
+
+def _format_seconds(value):
+    if value is None:
+        return '-'
+    if value < 1:
+        return '%.1fms' % (value * 1000)
+    return '%.2fs' % value
+
+
+# Stats shared by the whole process
+STATS = Stats()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.stats.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+
+def serve(port, host='127.0.0.1', stats=STATS):
+    """Serve the stats in Prometheus format over HTTP from a background
+    thread, returns the server.
+    """
+    server = HTTPServer((host, port), _MetricsHandler)
+    server.stats = stats
+    thread = threading.Thread(target=server.serve_forever,
+                              name='hippybot-stats')
+    thread.daemon = True
+    thread.start()
+    return server
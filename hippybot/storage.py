@@ -0,0 +1,262 @@
+import os
+import os.path
+import time
+import logging
+import sqlite3
+import threading
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+DEFAULT_PATH = os.path.expanduser('~/.hippybot/storage.sqlite')
+# Seconds between flushes of buffered writes
+DEFAULT_FLUSH_INTERVAL = 1.0
+# Number of buffered writes that triggers an early flush
+DEFAULT_MAX_PENDING = 1000
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS kv ("
+    "  bucket TEXT NOT NULL,"
+    "  scope TEXT NOT NULL,"
+    "  key TEXT NOT NULL,"
+    "  value TEXT NOT NULL,"
+    "  PRIMARY KEY (bucket, scope, key))",
+)
+
+# UPSERT needs SQLite 3.24, older versions fall back to insert + update
+if sqlite3.sqlite_version_info >= (3, 24, 0):
+    INCREMENT = (
+        "INSERT INTO kv (bucket, scope, key, value) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT (bucket, scope, key) DO UPDATE "
+        "SET value = value + excluded.value",
+    )
+else:
+    INCREMENT = (
+        "INSERT OR IGNORE INTO kv (bucket, scope, key, value) "
+        "VALUES (?, ?, ?, '0')",
+        "UPDATE kv SET value = value + ? "
+        "WHERE bucket = ? AND scope = ? AND key = ?",
+    )
+
+# Buffered operations
+SET, DELETE, INCR = 'set', 'delete', 'incr'
+
+log = logging.getLogger(__name__)
+
+
+def _combine(earlier, later):
+    """Returns the single buffered operation with the effect of earlier
+    followed by later, either of which may be None.
+    """
+    if earlier is None or later is None:
+        return later or earlier
+    op, value = later
+    if op != INCR:
+        return later
+    if earlier[0] == INCR:
+        return INCR, earlier[1] + value
+    # Fold into the buffered set (or delete) so the flush stays a single
+    # statement per key
+    return SET, (earlier[1] or 0) + value
+
+
+class Storage(object):
+    """Key/value storage service shared by plugins, available to them as
+    ``self.bot.storage``.
+
+    Values are JSON encoded and grouped into named buckets, with an optional
+    scope (e.g. a room) inside each bucket. Writes are buffered in memory
+    and reads are served from that buffer first. A background thread
+    flushes them in a single transaction every flush_interval seconds, when
+    max_pending writes are waiting, and on close(). A burst of writes
+    therefore costs one commit rather than one each. Writes made within
+    the last flush_interval can be lost if the process dies.
+    """
+    def __init__(self, path=DEFAULT_PATH, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 max_pending=DEFAULT_MAX_PENDING):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._buckets = {}
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._db = self._connect()
+        self._flusher = threading.Thread(target=self._run_flusher,
+                                         name='hippybot-storage')
+        self._flusher.daemon = True
+        self._flusher.start()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        with db:
+            for statement in SCHEMA:
+                db.execute(statement)
+        return db
+
+    def bucket(self, name):
+        """Returns the Bucket with the given name, normally the plugin's
+        name.
+        """
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            bucket = self._buckets.setdefault(name, Bucket(self, name))
+        return bucket
+
+    def pending(self):
+        """Number of writes waiting to be flushed.
+        """
+        return len(self._pending)
+
+    def _stored(self, ident):
+        row = self._db.execute("SELECT value FROM kv WHERE bucket = ? AND "
+                               "scope = ? AND key = ?", ident).fetchone()
+        if row is None:
+            return False, None
+        return True, json.loads(row[0])
+
+    def _read(self, ident):
+        """Returns (exists, value) for a key, applying any buffered write.
+        """
+        op = self._pending.get(ident)
+        if op is not None and op[0] != INCR:
+            return op[0] == SET, op[1] if op[0] == SET else None
+        exists, value = self._stored(ident)
+        if op is not None:
+            return True, (value or 0) + op[1]
+        return exists, value
+
+    def _write(self, ident, op, value=None):
+        with self._lock:
+            if self._closed:
+                raise ValueError('Storage is closed')
+            self._pending[ident] = _combine(self._pending.get(ident),
+                                            (op, value))
+            if len(self._pending) >= self.max_pending:
+                self._wakeup.set()
+
+    def _scope_items(self, bucket, scope):
+        rows = self._db.execute("SELECT key, value FROM kv WHERE bucket = ? "
+                                "AND scope = ?", (bucket, scope))
+        items = dict((key, json.loads(value)) for key, value in rows)
+        for (b, s, key), (op, value) in self._pending.items():
+            if b != bucket or s != scope:
+                continue
+            if op == SET:
+                items[key] = value
+            elif op == DELETE:
+                items.pop(key, None)
+            else:
+                items[key] = items.get(key, 0) + value
+        return items
+
+    def flush(self):
+        """Write all buffered changes in one transaction.
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            sets, deletes, incrs = [], [], []
+            for (bucket, scope, key), (op, value) in pending.iteritems():
+                if op == SET:
+                    sets.append((bucket, scope, key, json.dumps(value)))
+                elif op == DELETE:
+                    deletes.append((bucket, scope, key))
+                else:
+                    incrs.append((bucket, scope, key, value))
+            try:
+                with self._db:
+                    self._db.executemany("INSERT OR REPLACE INTO kv "
+                        "(bucket, scope, key, value) VALUES (?, ?, ?, ?)", sets)
+                    self._db.executemany("DELETE FROM kv WHERE bucket = ? AND "
+                        "scope = ? AND key = ?", deletes)
+                    if len(INCREMENT) == 1:
+                        self._db.executemany(INCREMENT[0], incrs)
+                    else:
+                        self._db.executemany(INCREMENT[0],
+                                             [i[:3] for i in incrs])
+                        self._db.executemany(INCREMENT[1],
+                                             [(i[3],) + i[:3] for i in incrs])
+            except Exception:
+                # Put the writes back, ahead of any made since
+                for ident, op in pending.iteritems():
+                    self._pending[ident] = _combine(op,
+                                                    self._pending.get(ident))
+                raise
+            return len(pending)
+
+    def _run_flusher(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception, e:
+                log.exception('Unable to flush storage to %s: %s',
+                              self.path, e)
+                time.sleep(self.flush_interval)
+
+    def close(self):
+        """Flush outstanding writes and stop the flush thread.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self.flush()
+            self._closed = True
+        self._wakeup.set()
+        self._flusher.join(5)
+        self._db.close()
+
+
+class Bucket(object):
+    """A named namespace of keys in Storage.
+    """
+    def __init__(self, storage, name):
+        self._storage = storage
+        self.name = name
+
+    def get(self, key, default=None, scope=''):
+        with self._storage._lock:
+            exists, value = self._storage._read((self.name, scope, key))
+        return value if exists else default
+
+    def set(self, key, value, scope=''):
+        self._storage._write((self.name, scope, key), SET, value)
+
+    def delete(self, key, scope=''):
+        self._storage._write((self.name, scope, key), DELETE)
+
+    def incr(self, key, delta=1, scope=''):
+        """Add delta to a numeric value, starting from 0, and return the
+        new value.
+        """
+        ident = (self.name, scope, key)
+        with self._storage._lock:
+            self._storage._write(ident, INCR, delta)
+            return self._storage._read(ident)[1]
+
+    def pop(self, key, default=None, scope=''):
+        """Atomically remove a key, returning its value.
+        """
+        ident = (self.name, scope, key)
+        with self._storage._lock:
+            exists, value = self._storage._read(ident)
+            if not exists:
+                return default
+            self._storage._write(ident, DELETE)
+            return value
+
+    def items(self, scope=''):
+        """Returns a list of (key, value) pairs in scope.
+        """
+        with self._storage._lock:
+            return self._storage._scope_items(self.name, scope).items()
@@ -0,0 +1,156 @@
+import time
+import logging
+import threading
+from collections import deque
+
+from hippybot.stats import STATS
+
+# Seconds a handler may run before it's reported and, when running in the
+# worker pool, abandoned
+DEFAULT_BUDGET = 30
+# Handlers taking longer than this many seconds are written to the slow log
+DEFAULT_SLOW_THRESHOLD = 1.0
+# A handler that overruns its budget this many times within strike_window
+# seconds is skipped for cooldown seconds
+DEFAULT_STRIKES = 3
+DEFAULT_STRIKE_WINDOW = 600
+DEFAULT_COOLDOWN = 300
+# Seconds between checks for handlers over budget
+CHECK_INTERVAL = 0.5
+
+log = logging.getLogger(__name__)
+# Slow handler records, see the slow_log option of the [watchdog] section
+slow_log = logging.getLogger('hippybot.slowlog')
+
+
+class Run(object):
+    """A handler invocation being watched.
+    """
+    __slots__ = ('name', 'mess', 'started', 'budget', 'job', 'overrun')
+
+    def __init__(self, name, mess, started, budget, job):
+        self.name = name
+        self.mess = mess
+        self.started = started
+        self.budget = budget
+        self.job = job
+        self.overrun = False
+
+    def describe(self, elapsed):
+        mess = self.mess
+        return 'handler=%s elapsed=%.3fs budget=%gs type=%s from=%s body=%r' % (
+            self.name, elapsed, self.budget, mess.getType(), mess.getFrom(),
+            mess.getBody())
+
+
+class Watchdog(object):
+    """Keeps track of running plugin handlers and enforces time budgets.
+
+    A background thread checks the handlers that are running, any over its
+    budget is reported and passed to on_overrun() (the bot uses that to
+    abandon the worker pool job running it). Handlers slower than
+    slow_threshold are recorded in the slow log, and handlers that overrun
+    too often are put in a cooldown during which the bot skips them.
+    """
+    def __init__(self, budget=DEFAULT_BUDGET, budgets=None,
+                 slow_threshold=DEFAULT_SLOW_THRESHOLD,
+                 strikes=DEFAULT_STRIKES, strike_window=DEFAULT_STRIKE_WINDOW,
+                 cooldown=DEFAULT_COOLDOWN, on_overrun=None,
+                 interval=CHECK_INTERVAL):
+        self.budget = budget
+        self.budgets = budgets or {}
+        self.slow_threshold = slow_threshold
+        self.strikes = strikes
+        self.strike_window = strike_window
+        self.cooldown = cooldown
+        self.on_overrun = on_overrun
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._running = set()
+        self._strikes = {}
+        self._cooling = {}
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        name='hippybot-watchdog')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def budget_for(self, name):
+        return self.budgets.get(name, self.budget)
+
+    def start(self, name, mess, job=None):
+        """Start watching a handler, returns the Run to pass to finish().
+        """
+        run = Run(name, mess, time.time(), self.budget_for(name), job)
+        with self._lock:
+            self._running.add(run)
+        return run
+
+    def finish(self, run):
+        elapsed = time.time() - run.started
+        with self._lock:
+            self._running.discard(run)
+        if elapsed >= self.slow_threshold:
+            STATS.incr('slow_handlers_total', handler=run.name)
+            slow_log.warn(run.describe(elapsed))
+        if elapsed > run.budget and not run.overrun:
+            # Finished before the watchdog noticed, still counts
+            self._strike(run.name)
+        return elapsed
+
+    def cooling(self, name):
+        """Returns the seconds left of a handler's cooldown, 0 if it isn't
+        in one.
+        """
+        until = self._cooling.get(name)
+        if until is None:
+            return 0
+        remaining = until - time.time()
+        if remaining <= 0:
+            self._cooling.pop(name, None)
+            return 0
+        return remaining
+
+    def _strike(self, name):
+        now = time.time()
+        with self._lock:
+            strikes = self._strikes.setdefault(name, deque())
+            strikes.append(now)
+            while strikes and strikes[0] < now - self.strike_window:
+                strikes.popleft()
+            if len(strikes) < self.strikes:
+                return
+            strikes.clear()
+            self._cooling[name] = now + self.cooldown
+        STATS.incr('handler_cooldowns_total', handler=name)
+        log.warn('Handler %s overran its budget %d times in %ds, disabled '
+                 'for %ds', name, self.strikes, self.strike_window,
+                 self.cooldown)
+
+    def check(self):
+        """Report handlers that are over budget, each only once.
+        """
+        now = time.time()
+        with self._lock:
+            overrun = [run for run in self._running
+                       if not run.overrun and now - run.started > run.budget]
+            for run in overrun:
+                run.overrun = True
+        for run in overrun:
+            STATS.incr('handler_overruns_total', handler=run.name)
+            log.error('Handler over budget: %s', run.describe(
+                now - run.started))
+            self._strike(run.name)
+            if self.on_overrun is not None:
+                try:
+                    self.on_overrun(run)
+                except Exception, e:
+                    log.exception('Error handling overrun of %s: %s',
+                                  run.name, e)
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self.check()
+
+    def close(self):
+        self._closed.set()
@@ -0,0 +1,288 @@
+import time
+import logging
+import threading
+from collections import deque
+
+from hippybot.stats import STATS
+
+log = logging.getLogger(__name__)
+
+
+class Tier(object):
+    """A priority level of the pool's work, jobs of earlier tiers always run
+    first.
+
+    A tier queues up to queue_size jobs (0 is unbounded) and its jobs should
+    start within target seconds. When a job starts later than that the pool
+    is falling behind, so every lower tier's queued jobs are shed. Jobs of a
+    sheddable tier are also shed, rather than run, when they're late or
+    don't fit in its queue. Submitting to a full tier that isn't sheddable
+    blocks instead.
+    """
+    __slots__ = ('name', 'queue_size', 'target', 'sheddable')
+
+    def __init__(self, name, queue_size=0, target=None, sheddable=True):
+        self.name = name
+        self.queue_size = queue_size
+        self.target = target
+        self.sheddable = sheddable
+
+
+# (name, target seconds, sheddable) of the tiers the bot runs handlers in:
+# commands addressed to the bot, global commands, content and @listen
+# handlers, and plugins' all_msg_handlers
+DEFAULT_TIERS = (
+    ('direct', 1.0, False),
+    ('global', 5.0, True),
+    ('content', 10.0, True),
+    ('all_msg', 30.0, True),
+)
+
+
+class Job(object):
+    """A unit of work submitted to the pool, collects any replies sent while
+    it runs so they can be delivered in arrival order for its room.
+    """
+    __slots__ = ('key', 'seq', 'func', 'args', 'replies', 'done',
+                 'abandoned', 'worker', 'tier', 'queued_at')
+
+    def __init__(self, key, seq, func, args, tier=0):
+        self.key = key
+        self.seq = seq
+        self.func = func
+        self.args = args
+        self.replies = []
+        self.done = False
+        self.abandoned = False
+        self.worker = None
+        self.tier = tier
+        self.queued_at = time.time()
+
+
+class HandlerPool(object):
+    """Bounded pool of worker threads used to run message handlers off the
+    XMPP read loop.
+
+    Jobs are keyed (normally by room JID), jobs with the same key may run
+    concurrently but the replies they produce are handed to deliver() in the
+    order the jobs were submitted to their tier.
+
+    Work is split into priority tiers, see Tier. Without tiers the pool has
+    a single one holding up to queue_size jobs. reserved workers are kept
+    for the first tier, so it never waits for the others' jobs to finish.
+    """
+    def __init__(self, size, deliver, queue_size=0, name='hippybot-worker',
+                 tiers=None, reserved=0):
+        self._deliver = deliver
+        self.tiers = tuple(tiers or (Tier('default', queue_size,
+                                          sheddable=False),))
+        self._tier_index = dict((tier.name, i)
+                                for i, tier in enumerate(self.tiers))
+        self._queues = [deque() for _ in self.tiers]
+        self.reserved = min(reserved, size - 1) if len(self.tiers) > 1 else 0
+        # Both guard the queues and the count of running jobs outside the
+        # first tier, workers wait on _ready for jobs and submitters on
+        # _space for room in a full tier. Taken before _lock when both are
+        # needed.
+        queue_lock = threading.Lock()
+        self._ready = threading.Condition(queue_lock)
+        self._space = threading.Condition(queue_lock)
+        self._running = 0
+        self._stopping = False
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._next_seq = {}
+        self._pending = {}
+        self._threads = []
+        self._name = name
+        self._started = 0
+        for i in range(size):
+            self._start_worker()
+
+    def _start_worker(self):
+        t = threading.Thread(target=self._work, name='%s-%d' % (
+            self._name, self._started))
+        t.daemon = True
+        t.start()
+        self._started += 1
+        self._threads.append(t)
+
+    @property
+    def size(self):
+        return len(self._threads)
+
+    def depth(self, tier=None):
+        """Number of queued jobs, in one tier or all of them.
+        """
+        if tier is not None:
+            return len(self._queues[self._tier_index[tier]])
+        return sum(len(queue) for queue in self._queues)
+
+    def pending(self):
+        """Number of submitted jobs that haven't finished yet, including
+        those being run.
+        """
+        with self._lock:
+            return sum(len(jobs) for jobs in self._pending.itervalues())
+
+    def current(self):
+        """Returns the job being run by the calling thread, if any.
+        """
+        return getattr(self._local, 'job', None)
+
+    def submit(self, key, func, *args):
+        """Queue func(*args) to be run by a worker in the first tier.
+        """
+        return self.submit_to(self.tiers[0].name, key, func, *args)
+
+    def submit_to(self, tier, key, func, *args):
+        """Queue func(*args) to be run by a worker in the named tier.
+        Returns the job, or None if it was shed because the tier is full.
+        """
+        index = self._tier_index[tier]
+        spec = self.tiers[index]
+        queue = self._queues[index]
+        with self._ready:
+            while spec.queue_size and len(queue) >= spec.queue_size:
+                if spec.sheddable:
+                    STATS.incr('pool_shed_total', tier=spec.name,
+                               reason='full')
+                    return None
+                self._space.wait()
+            with self._lock:
+                # Replies are ordered per tier, so a command's reply isn't
+                # held back by slower content handlers in the same room
+                key = (index, key)
+                seq = self._next_seq.get(key, 0)
+                self._next_seq[key] = seq + 1
+                job = Job(key, seq, func, args, index)
+                self._pending.setdefault(key, []).append(job)
+            queue.append(job)
+            self._ready.notify()
+        return job
+
+    def abandon(self, job):
+        """Stop waiting for a job that's taking too long. Replies it has
+        already sent are delivered, later ones are dropped, and jobs queued
+        behind it for the same key are no longer held up. Its worker thread
+        is replaced and exits once the job eventually returns. Returns False
+        if the job had already finished.
+        """
+        return self._finish(job, abandon=True)
+
+    def shutdown(self):
+        """Stop the workers once the queued jobs have been run.
+        """
+        with self._ready:
+            self._stopping = True
+            self._ready.notify_all()
+        for t in self._threads:
+            t.join(5)
+        self._threads = []
+
+    def _work(self):
+        while True:
+            job, shed = self._take()
+            for stale in shed:
+                self._finish(stale)
+            if job is None:
+                if shed:
+                    continue
+                return
+            self._local.job = job
+            job.worker = threading.current_thread()
+            try:
+                job.func(*job.args)
+            except Exception, e:
+                log.exception('Unhandled error in worker job for %s: %s',
+                              job.key[1], e)
+            finally:
+                self._local.job = None
+            if not self._finish(job):
+                # Abandoned, a replacement worker has already been started
+                return
+
+    def _take(self):
+        """Waits for the next job to run, returns it and the jobs shed
+        meanwhile, which the caller must finish. The job is None if there
+        were only jobs to shed, or if the pool is shutting down.
+        """
+        shed = []
+        with self._ready:
+            while True:
+                job = self._next(shed)
+                if job is not None or shed or (self._stopping and
+                                               not self.depth()):
+                    return job, shed
+                self._ready.wait()
+
+    def _next(self, shed):
+        now = time.time()
+        for index, queue in enumerate(self._queues):
+            tier = self.tiers[index]
+            while queue:
+                if index and self._running >= \
+                        len(self._threads) - self.reserved:
+                    # The remaining workers are kept for the first tier
+                    return None
+                job = queue.popleft()
+                if tier.queue_size and not tier.sheddable:
+                    self._space.notify()
+                waited = now - job.queued_at
+                if tier.target is not None and waited > tier.target:
+                    STATS.incr('pool_late_total', tier=tier.name)
+                    # Falling behind, make room by shedding everything less
+                    # important first
+                    for lower in range(index + 1, len(self._queues)):
+                        self._shed(lower, shed)
+                    if tier.sheddable:
+                        shed.append(job)
+                        STATS.incr('pool_shed_total', tier=tier.name,
+                                   reason='late')
+                        continue
+                STATS.observe('queue_seconds', waited, tier=tier.name)
+                if index:
+                    self._running += 1
+                return job
+        return None
+
+    def _shed(self, index, shed):
+        queue = self._queues[index]
+        if queue:
+            STATS.incr('pool_shed_total', len(queue),
+                       tier=self.tiers[index].name, reason='overload')
+            shed.extend(queue)
+            queue.clear()
+
+    def _finish(self, job, abandon=False):
+        """Marks a job as done and delivers any replies that are now due,
+        returns False if it was already done.
+        """
+        with self._lock:
+            if job.done:
+                return False
+            job.done = True
+            if abandon:
+                job.abandoned = True
+                if job.worker in self._threads:
+                    self._threads.remove(job.worker)
+                self._start_worker()
+            pending = self._pending[job.key]
+            # Only flush from the head of the room's queue, so replies from
+            # a fast job never overtake those of an earlier slow one
+            while pending and pending[0].done:
+                head = pending.pop(0)
+                for reply in head.replies:
+                    try:
+                        self._deliver(reply)
+                    except Exception, e:
+                        log.exception('Unable to deliver reply for %s: %s',
+                                      head.key[1], e)
+            if not pending:
+                del self._pending[job.key]
+                del self._next_seq[job.key]
+        if job.tier and job.worker is not None:
+            with self._ready:
+                self._running -= 1
+                self._ready.notify()
+        return True
@@ -19,7 +19,7 @@ setup(
     author='Wes Mason',
     author_email='wes[at]1stvamp[dot]org',
     url='http://github.com/1stvamp/hippybot',
-    packages=find_packages(exclude=['ez_setup']),
+    packages=find_packages(exclude=['ez_setup', 'benchmarks', 'tests']),
     install_requires=open('requirements.txt').readlines(),
     package_data={'hippybot': ['version.txt']},
     include_package_data=True,
@@ -27,7 +27,8 @@ setup(
         'plugins': open('extras_requirements.txt').readlines(),
     },
     entry_points={
-        'console_scripts': ['hippybot = hippybot.bot:main', 'hippybotctl = hippybot.bot:control'],
+        'console_scripts': ['hippybot = hippybot.bot:main', 'hippybotctl = hippybot.bot:control',
+                            'hippybot-standin = hippybot.standin:main'],
     },
     license='BSD'
 )
@@ -0,0 +1,9 @@
+"""Plugin run in a worker process by test_isolation.
+"""
+from hippybot.decorators import status
+
+
+class Plugin(object):
+    @status(color='green', regex=r'deployed (\w+)')
+    def deployed(self, user, body, match=None, **kwargs):
+        return u'%s deployed <b>%s</b>' % (user, match.group(1))
@@ -0,0 +1,61 @@
+import threading
+import unittest
+
+from jabberbot import xmpp
+
+from hippybot.isolation import IsolatedPlugin
+from hippybot.lookup import User, Room
+
+
+class FakeLookup(object):
+    def get_sending_user(self, jid):
+        return User(user_id=2, name=u'Joe Bloggs', mention_name=u'JoeBloggs',
+                    xmpp_jid=u'1_2@chat.hipchat.com')
+
+    def get_sending_room(self, jid):
+        return Room(room_id=5, name=u'Dev', xmpp_jid=u'1_dev@conf.hipchat.com')
+
+
+class FakeNotifier(object):
+    def __init__(self):
+        self.notifications = []
+        self.notified = threading.Event()
+
+    def notify(self, *args, **kwargs):
+        self.notifications.append((args, kwargs))
+        self.notified.set()
+
+
+class FakeBot(object):
+    def __init__(self):
+        self._config = {'connection': {'nickname': 'HippyBot'}}
+        self._username = u'1_1@chat.hipchat.com'
+        self._lookup = FakeLookup()
+        self.notifier = FakeNotifier()
+
+    def to_bot(self, mess):
+        return False, mess.getBody()
+
+
+class IsolatedStatusTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = FakeBot()
+        self.plugin = IsolatedPlugin(self.bot, 'tests.isolated_status',
+                                     timeout=10)
+
+    def tearDown(self):
+        self.plugin.close()
+
+    def test_status_notifies_through_the_bot(self):
+        mess = xmpp.Message(to='1_1@chat.hipchat.com', typ='groupchat',
+                            frm='1_dev@conf.hipchat.com/Joe Bloggs',
+                            body='deployed api')
+        self.assertEqual(self.plugin.call('content', 'deployed', mess), None)
+        self.assertTrue(self.bot.notifier.notified.wait(10))
+        self.assertEqual(self.bot.notifier.notifications, [
+            ((5, u'@JoeBloggs deployed <b>api</b>', 'HippyBot'),
+             {'color': 'green', 'format': 'html'})])
+
+
+if __name__ == '__main__':
+    unittest.main()